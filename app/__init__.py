@@ -1,4 +1,4 @@
-from flask import Flask, render_template, url_for
+from flask import Flask, Request, render_template, url_for
 from flask_sqlalchemy import SQLAlchemy
 from os import path
 from flask_login import LoginManager, current_user
@@ -14,6 +14,7 @@ import stripe
 import cloudinary
 import cloudinary.uploader
 from werkzeug.utils import secure_filename
+from io import BytesIO
 socketio = SocketIO()
 
 migrate = Migrate()
@@ -39,8 +40,17 @@ def update_user_order_counts(app):
     db.session.commit()
     print('Updated order counts for all users!')
 
-def create_app():
+class BoundedUploadRequest(Request):
+  # requests with a size limit (request.max_content_length, e.g. image search) keep their file uploads in memory,
+  # Werkzeug would otherwise spool anything over 500KB to a temporary file
+  def _get_file_stream(self, total_content_length, content_type, filename=None, content_length=None):
+    if self.max_content_length is not None:
+      return BytesIO()
+    return super()._get_file_stream(total_content_length, content_type, filename, content_length)
+
+def create_app(test_config=None):
   app = Flask(__name__)
+  app.request_class = BoundedUploadRequest
   app.config['SECRET_KEY'] = '123456789'
   app.config['SQLALCHEMY_DATABASE_URI'] = f'sqlite:///{DB_NAME}'
   app.config['MAIL_SERVER'] = 'smtp.googlemail.com'
@@ -78,6 +88,38 @@ def create_app():
   app.config['UPLOAD_CHALLENGE_FOLDER'] = os.path.join(app.root_path, 'static', 'media', 'challenge') # image search challenge
   if not os.path.exists(app.config['UPLOAD_CHALLENGE_FOLDER']):
     os.makedirs(app.config['UPLOAD_CHALLENGE_FOLDER'])
+  app.config['EMBEDDING_CACHE_FOLDER'] = os.path.join(app.instance_path, 'embeddings') # persistent CLIP embedding cache
+  app.config['EMBEDDING_BATCH_SIZE'] = 32 # images per CLIP forward pass
+  app.config['EMBEDDING_DECODE_WORKERS'] = 4 # threads decoding images ahead of the model
+  app.config['VECTOR_INDEX_IVF_THRESHOLD'] = 5000 # catalog images before image search switches to the IVF index
+  app.config['VECTOR_INDEX_NPROBE'] = 8 # IVF clusters scanned per query
+  app.config['VECTOR_INDEX_PRECISION'] = os.getenv('VECTOR_INDEX_PRECISION', 'float32') # float32, float16 or int8 (reranked at full precision)
+  app.config['VISUAL_SEARCH_TOP_K'] = 8 # products returned by image search
+  app.config['SEMANTIC_SEARCH_TOP_K'] = 48 # products returned by text-to-image search (?mode=semantic)
+  app.config['VISUAL_SEARCH_MAX_UPLOAD_BYTES'] = 10 * 1024 * 1024 # image search uploads are decoded in memory, larger files are refused
+  app.config['VISUAL_SEARCH_MAX_PIXELS'] = 40_000_000
+  app.config['QUERY_CACHE_SIZE'] = 256 # entries per search query cache (see queryCache.py)
+  app.config['QUERY_CACHE_TTL'] = 60 * 60 # seconds
+  app.config['CATALOG_COUNT_TTL'] = 30 # seconds a product listing's total count is reused for
+  app.config['PAGE_CACHE_SIZE'] = 128 # rendered anonymous listing pages kept per worker (see pageCache.py)
+  app.config['PAGE_CACHE_TTL'] = 5 * 60 # seconds
+  app.config['CATALOG_VERSION_FILE'] = os.path.join(app.instance_path, 'catalog_version') # bumped by catalog writes, read by every worker
+  app.config['TAXONOMY_CACHE_TTL'] = 300 # seconds before another worker's category/genre edits show up in the filters
+  app.config['CLIP_WARM_UP'] = os.getenv('CLIP_WARM_UP', '0') == '1' # CLIP is otherwise loaded on first use
+  app.config['JOB_WORKERS'] = int(os.getenv('JOB_WORKERS', '2')) # background job threads per process, 0 runs jobs inline (see jobQueue.py)
+  app.config['JOB_POLL_SECONDS'] = 2
+  app.config['JOB_MAX_ATTEMPTS'] = 5
+  app.config['JOB_RETRY_SECONDS'] = 30 # first retry delay, doubled for each further attempt
+  app.config['JOB_TIMEOUT'] = 10 * 60 # seconds before a job left running by a dead process is picked up again
+  app.config['JOB_RETENTION'] = 24 * 60 * 60 # seconds finished and failed jobs are kept for
+  app.config['QUERY_BUDGET_CHECK'] = os.getenv('QUERY_BUDGET_CHECK', '0') == '1' # log routes that run more queries than expected (see loadProfiles.py)
+  app.config['EMBEDDING_WORKER_ADDRESS'] = os.getenv('EMBEDDING_WORKER_ADDRESS') # host:port of the embedding worker, embeds inline if unset
+  app.config['EMBEDDING_WORKER_TIMEOUT'] = float(os.getenv('EMBEDDING_WORKER_TIMEOUT', '10')) # seconds to wait for the worker before embedding inline
+  app.config['PRECOMPUTE_EMBEDDINGS'] = True # embed the catalog images on startup (tests skip it, CLIP isn't needed for them)
+
+  # overrides for tests, e.g. an in-memory database
+  if test_config:
+    app.config.update(test_config)
 
   # Cloudinary (uncomment only before, to save on credits.)    
   cloudinary.config( 
@@ -173,6 +215,10 @@ def create_app():
 
   app.register_blueprint(addToCart, url_prefix="/")
 
+  # per-route query counts
+  from .loadProfiles import register_query_budget
+  register_query_budget(app)
+
 
 
   # Initialise Database
@@ -182,6 +228,15 @@ def create_app():
 
   update_user_order_counts(app)
 
+  # Load CLIP in the background instead of on the first image search
+  if app.config['CLIP_WARM_UP']:
+    from .clipModel import clip
+    clip.warm_up()
+
+  # Background jobs (emails, Cloudinary, chat summaries, embeddings)
+  from .jobQueue import start_workers
+  start_workers(app)
+
   # User load
   login_manager = LoginManager()
   login_manager.login_view = 'auth.login'
@@ -242,6 +297,26 @@ def create_database(app):
       insert_vouchers()
       insert_trade_ins()
       
-    from .productPagination import precompute_product_embeddings
-    product_embeddings = precompute_product_embeddings()
-    app.config['PRODUCT_EMBEDDINGS'] = product_embeddings
\ No newline at end of file
+    # columns and indexes added since the database was created
+    from .schemaSync import upgrade_schema
+    from .models import Product, recount_condition_columns
+    upgrade_schema()
+    # conditions moved from the products.conditions JSON column to the product_conditions table
+    for product in Product.query.filter(~Product.condition_rows.any(), Product.conditions_json.isnot(None)):
+      product.conditions = product.conditions_json
+    unpriced = [product_id for product_id, in Product.query.filter(Product.price.is_(None), Product.condition_rows.any()).with_entities(Product.id)]
+    if unpriced:
+      recount_condition_columns(db.session, unpriced)
+    # review aggregates, kept up to date by review writes from now on
+    for product in Product.query.filter(Product.rating_count == 0, Product.reviews.any()):
+      product.update_rating()
+    db.session.commit()
+
+    # full-text product search, (re)built if the index is missing or out of step
+    from .productSearch import create_search_index
+    create_search_index()
+
+    if app.config['PRECOMPUTE_EMBEDDINGS']:
+      from .productPagination import precompute_product_embeddings
+      product_embeddings = precompute_product_embeddings()
+      app.config['PRODUCT_EMBEDDINGS'] = product_embeddings
\ No newline at end of file
@@ -1,14 +1,14 @@
 from flask import Blueprint, render_template, request, redirect, url_for, flash, session, current_app, jsonify
-from . import db, mail, oauth
+from . import db, oauth
 from .models import User, UserVoucher, Voucher
 from .forms import LoginForm, RegisterForm, UsernameForm, RequestResetForm, ResetPasswordForm, Verify2FAForm
 from werkzeug.security import generate_password_hash, check_password_hash
 from flask_login import login_user, login_required, logout_user, current_user
-from flask_mail import Message
 from dotenv import load_dotenv
 import os
 from secrets import token_urlsafe
 from .identicon import create_identicon
+from .jobQueue import enqueue
 from datetime import datetime, timedelta
 
 auth = Blueprint('auth', __name__)
@@ -217,8 +217,6 @@ def register_step2():
   return render_template("auth/setUsername.html", user=None, form=form)
 
 def send_reset_email(user):
-  current_app.config['UPDATE_MAIL_CONFIG']('auth')
-
   token = user.get_reset_token()
 
   reset_link = url_for('auth.reset_token', token=token, _external=True)
@@ -227,22 +225,14 @@ def send_reset_email(user):
 
   html_body = render_template('email/reset_password.html', user=user,reset_link=reset_link)
 
-  msg = Message(
-    'Password Reset Request', 
-    sender=('Rewwwind Help', current_app.config['MAIL_USERNAME']), 
-    recipients=[user.email],
-    html=html_body
-  )
-
-  # with open(image_path, 'rb') as img:
-  #   msg.attach(
-  #     'abstractheader1.jpg',
-  #     'image/jpeg',
-  #     img.read(),
-  #     'inline',
-  #     headers={'Content-ID': '<header_image>'} 
-  #   )
-  mail.send(msg)
+  # sent by a background job (see jobQueue.py)
+  enqueue('send_email', {
+    'account': 'auth',
+    'sender_name': 'Rewwwind Help',
+    'subject': 'Password Reset Request',
+    'recipients': [user.email],
+    'html': html_body
+  })
 
 @auth.route('/reset-password', methods=['GET', 'POST'])
 def reset_password_request():
@@ -254,6 +244,7 @@ def reset_password_request():
   if form.validate_on_submit():
     try:
       send_reset_email(form.user)
+      db.session.commit()
       flash('An email has been sent with instructions to reset your password.', 'info')
       if request.headers.get('X-Requested-With') == 'XMLHttpRequest':
         return jsonify({'success': True})
@@ -333,15 +324,12 @@ def verify_2fa():
   return render_template("auth/verify_2fa.html", form=form)
 
 def send_2fa_login_email(user, code):
-  current_app.config['UPDATE_MAIL_CONFIG']('auth')
-  
   html_body = render_template('email/2fa_login.html', user=user, code=code)
   
-  msg = Message(
-    'Login Verification Code', 
-    sender=('Rewwwind Help', current_app.config['MAIL_USERNAME']), 
-    recipients=[user.email],
-    html=html_body
-  )
-  
-  mail.send(msg)
\ No newline at end of file
+  enqueue('send_email', {
+    'account': 'auth',
+    'sender_name': 'Rewwwind Help',
+    'subject': 'Login Verification Code',
+    'recipients': [user.email],
+    'html': html_body
+  }, max_attempts=3)  # the code expires after 5 minutes
\ No newline at end of file
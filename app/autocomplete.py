@@ -0,0 +1,152 @@
+from sqlalchemy import event
+from sqlalchemy.orm import Session
+from bisect import bisect_left
+import re
+import threading
+import time
+
+from .models import Product, SubCategory
+
+# In-memory prefix index for search-as-you-type suggestions
+# Every suggestion (product name, creator, genre) is stored under each of its word starts in one sorted array,
+# so "blu" finds "Kind of Blue" and "Blue Train" with a binary search and a short scan, no database query.
+# Product and subcategory changes are applied incrementally once their transaction commits;
+# changes made by other worker processes are picked up by a full rebuild every REFRESH_SECONDS.
+REFRESH_SECONDS = 300
+SCAN_LIMIT = 200  # keys looked at per lookup, bounds the cost of very short prefixes
+KIND_ORDER = {'product': 0, 'creator': 1, 'genre': 2}
+
+def normalise(text):
+    return ' '.join(re.findall(r'\w+', (text or '').lower()))
+
+def word_starts(text):
+    # "kind of blue" -> (0, "kind of blue"), (1, "of blue"), (2, "blue")
+    words = normalise(text).split()
+    return [(i, ' '.join(words[i:])) for i in range(len(words))]
+
+class AutocompleteIndex:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.built_at = None
+        self.keys = []  # sorted (key, word position, suggestion), suggestion = (kind, text, product id)
+        self.products = {}  # product id -> (name, creator)
+        self.creators = {}  # creator -> number of products
+        self.genres = set()
+
+    @property
+    def stale(self):
+        return self.built_at is None or time.monotonic() - self.built_at > REFRESH_SECONDS
+
+    def build(self):
+        products = {product.id: (product.name, product.creator) for product in Product.query.with_entities(Product.id, Product.name, Product.creator)}
+        genres = {name for (name,) in SubCategory.query.with_entities(SubCategory.subcategory_name)}
+        with self._lock:
+            self.products = products
+            self.genres = genres
+            self.creators = {}
+            for _, creator in products.values():
+                if creator:
+                    self.creators[creator] = self.creators.get(creator, 0) + 1
+            suggestions = [('product', name, product_id) for product_id, (name, _) in products.items() if name]
+            suggestions += [('creator', creator, None) for creator in self.creators]
+            suggestions += [('genre', genre, None) for genre in genres]
+            self.keys = sorted((key, position, suggestion) for suggestion in suggestions for position, key in word_starts(suggestion[1]))
+            self.built_at = time.monotonic()
+
+    def apply(self, product_changes, genres_changed):
+        """Apply committed changes: {product id: (name, creator), or None when deleted}."""
+        if self.built_at is None:
+            return
+        if genres_changed:
+            # rare (taxonomy edits), not worth tracking individually
+            self.built_at = None
+            return
+        with self._lock:
+            removed, added = set(), []
+            for product_id, values in product_changes.items():
+                old_name, old_creator = self.products.pop(product_id, (None, None))
+                if old_name:
+                    removed.add(('product', old_name, product_id))
+                if old_creator:
+                    self.creators[old_creator] -= 1
+                    if not self.creators[old_creator]:
+                        del self.creators[old_creator]
+                        removed.add(('creator', old_creator, None))
+                if values is None:
+                    continue
+                name, creator = values
+                self.products[product_id] = values
+                if name:
+                    added.append(('product', name, product_id))
+                if creator:
+                    if creator not in self.creators:
+                        added.append(('creator', creator, None))
+                    self.creators[creator] = self.creators.get(creator, 0) + 1
+            # suggestions that were removed and re-added in the same batch (e.g. a price edit) stay as they are
+            unchanged = removed.intersection(added)
+            removed -= unchanged
+            added = [suggestion for suggestion in added if suggestion not in unchanged]
+
+            # copy-on-write, lookups never see a half-updated array
+            keys = [entry for entry in self.keys if entry[2] not in removed]
+            keys += [(key, position, suggestion) for suggestion in added for position, key in word_starts(suggestion[1])]
+            keys.sort()
+            self.keys = keys
+
+    def lookup(self, prefix, limit=8):
+        prefix = normalise(prefix)
+        if not prefix:
+            return []
+        keys = self.keys
+        matches = {}
+        i = bisect_left(keys, (prefix,))
+        end = min(len(keys), i + SCAN_LIMIT)
+        while i < end and keys[i][0].startswith(prefix):
+            _, position, suggestion = keys[i]
+            # suggestions whose text starts with the prefix rank above mid-phrase matches
+            rank = (position > 0, KIND_ORDER[suggestion[0]], len(suggestion[1]))
+            if suggestion not in matches or rank < matches[suggestion]:
+                matches[suggestion] = rank
+            i += 1
+        return sorted(matches, key=matches.get)[:limit]
+
+index = AutocompleteIndex()
+
+def suggestions(prefix, limit=8):
+    if index.stale:
+        index.build()
+    return index.lookup(prefix, limit)
+
+# collect changes per session, apply them once they are committed
+@event.listens_for(Product, 'after_insert')
+@event.listens_for(Product, 'after_update')
+def record_product(mapper, connection, product):
+    session = Session.object_session(product)
+    if session is not None:
+        session.info.setdefault('autocomplete_products', {})[product.id] = (product.name, product.creator)
+
+@event.listens_for(Product, 'after_delete')
+def record_product_deleted(mapper, connection, product):
+    session = Session.object_session(product)
+    if session is not None:
+        session.info.setdefault('autocomplete_products', {})[product.id] = None
+
+@event.listens_for(SubCategory, 'after_insert')
+@event.listens_for(SubCategory, 'after_update')
+@event.listens_for(SubCategory, 'after_delete')
+def record_genre(mapper, connection, subcategory):
+    session = Session.object_session(subcategory)
+    if session is not None:
+        session.info['autocomplete_genres'] = True
+
+@event.listens_for(Session, 'after_commit')
+def apply_changes(session):
+    product_changes = session.info.pop('autocomplete_products', {})
+    genres_changed = session.info.pop('autocomplete_genres', False)
+    if product_changes or genres_changed:
+        index.apply(product_changes, genres_changed)
+
+@event.listens_for(Session, 'after_soft_rollback')
+def discard_changes(session, previous_transaction):
+    session.info.pop('autocomplete_products', None)
+    session.info.pop('autocomplete_genres', None)
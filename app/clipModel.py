@@ -0,0 +1,130 @@
+from flask import current_app
+from PIL import Image
+import numpy as np
+import io
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from .embeddings import EMBEDDING_MODEL
+
+# Lazily loaded CLIP model
+# torch, transformers and the model weights are only loaded the first time an embedding is needed,
+# so workers and CLI commands that never run image search don't pay for them.
+class ClipModelHolder:
+    def __init__(self, model_name=EMBEDDING_MODEL):
+        self.model_name = model_name
+        self._lock = threading.Lock()
+        self._model = None
+        self._processor = None
+
+    @property
+    def loaded(self):
+        return self._model is not None
+
+    def load(self):
+        if self._model is None:
+            with self._lock:
+                # another thread may have finished loading while we waited
+                if self._model is None:
+                    from transformers import CLIPProcessor, CLIPModel
+                    print(f"Loading {self.model_name}...")
+                    processor = CLIPProcessor.from_pretrained(self.model_name)
+                    model = CLIPModel.from_pretrained(self.model_name)
+                    model.eval()
+                    self._processor = processor
+                    self._model = model
+        return self._model, self._processor
+
+    def warm_up(self):
+        # load in the background so the first image search doesn't wait for it
+        thread = threading.Thread(target=self.load, name='clip-warm-up', daemon=True)
+        thread.start()
+        return thread
+
+clip = ClipModelHolder()
+
+# image_path can also be a file-like object
+def load_image(image_path):
+    return Image.open(image_path).convert('RGB')
+
+# Search query images are decoded in memory, they never touch the disk
+# CLIP only looks at 224x224, so anything larger is shrunk as early as possible:
+# JPEGs are decoded straight at reduced scale (draft), everything else is thumbnailed right after decoding.
+DOWNSCALE_SIZE = 448
+
+def decode_image(stream, max_bytes=None, max_pixels=None, max_side=DOWNSCALE_SIZE):
+    """
+    Decode an uploaded image from a stream or bytes, raises ValueError if it is too large or unreadable.
+    The limits default to VISUAL_SEARCH_MAX_UPLOAD_BYTES and VISUAL_SEARCH_MAX_PIXELS.
+    """
+    max_bytes = max_bytes or current_app.config['VISUAL_SEARCH_MAX_UPLOAD_BYTES']
+    max_pixels = max_pixels or current_app.config['VISUAL_SEARCH_MAX_PIXELS']
+    image_bytes = stream if isinstance(stream, bytes) else stream.read(max_bytes + 1)
+    if len(image_bytes) > max_bytes:
+        raise ValueError(f"Image file is too large, the limit is {max_bytes / (1024 * 1024):g} MB.")
+    try:
+        image = Image.open(io.BytesIO(image_bytes))
+        # only the header has been read so far, refuse decompression bombs before decoding any pixels
+        width, height = image.size
+        if width * height > max_pixels:
+            raise ValueError(f"Image resolution is too large, the limit is {max_pixels / 1_000_000:g} megapixels.")
+        image.draft('RGB', (max_side, max_side))
+        image = image.convert('RGB')
+    except (OSError, Image.DecompressionBombError) as e:
+        raise ValueError(f"Could not read image: {e}")
+    image.thumbnail((max_side, max_side))
+    return image
+
+def encode_image(image):
+    # lossless, the image has already been downscaled so this stays small
+    buffer = io.BytesIO()
+    image.save(buffer, format='PNG')
+    return buffer.getvalue()
+
+# One forward pass over a list of decoded images, one embedding row per image
+def embed_pil_images(images):
+    import torch
+    model, processor = clip.load()
+    inputs = processor(images=images, return_tensors="pt")
+    with torch.no_grad():
+        features = model.get_image_features(**inputs)
+    return features.numpy()
+
+# Text embeddings in the same space as the image embeddings, one row per text
+def embed_texts(texts):
+    import torch
+    model, processor = clip.load()
+    inputs = processor(text=texts, return_tensors="pt", padding=True, truncation=True)
+    with torch.no_grad():
+        features = model.get_text_features(**inputs)
+    return features.numpy()
+
+# Function to extract image embedding using CLIP
+# image can be a path, a file-like object or an already decoded PIL image
+def extract_image_embedding(image):
+    if not isinstance(image, Image.Image):
+        image = load_image(image)
+    return embed_pil_images([image])[0]
+
+# Batched version of extract_image_embedding for catalog embedding
+# Images are decoded in a thread pool (the next batch decodes while the model runs on the current one),
+# and each batch goes through a single forward pass.
+def embed_images(image_paths, batch_size=None, workers=None):
+    if not image_paths:
+        return np.zeros((0, 0), dtype=np.float32)
+
+    batch_size = batch_size or current_app.config['EMBEDDING_BATCH_SIZE']
+    workers = workers or current_app.config['EMBEDDING_DECODE_WORKERS']
+
+    batches = [image_paths[start:start + batch_size] for start in range(0, len(image_paths), batch_size)]
+    results = []
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        upcoming = [pool.submit(load_image, image_path) for image_path in batches[0]]
+        for i in range(len(batches)):
+            images = [future.result() for future in upcoming]
+            if i + 1 < len(batches):
+                upcoming = [pool.submit(load_image, image_path) for image_path in batches[i + 1]]
+
+            results.append(embed_pil_images(images))
+
+    return np.vstack(results)
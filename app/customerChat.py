@@ -4,6 +4,7 @@ from flask_socketio import emit, join_room, leave_room
 from .roleDecorator import role_required
 from . import db, socketio
 from .models import User, Role, ChatHistory
+from .jobQueue import job, enqueue
 from datetime import datetime
 import google.generativeai as genai
 from math import ceil
@@ -312,6 +313,22 @@ def handle_message(data):
       'timestamp': datetime.now().strftime('%H:%M')
     }, room=room_id)
 
+# generate summary with Gemini (background job, see jobQueue.py)
+@job('summarise_chat')
+def summarise_chat(chat_history_id):
+  chat_history = ChatHistory.query.get(chat_history_id)
+  if chat_history is None or chat_history.chat_summary:
+    return
+
+  chat_text = "\n".join([f"{msg['type']}: {msg['message']}" for msg in chat_history.chat])
+  prompt = f"Please provide a brief summary of this customer service chat:\n\n{chat_text}"
+
+  response = chat_model.generate_content(prompt)
+
+  # update the chat history with summary
+  chat_history.chat_summary = response.text
+  db.session.commit()
+
 # Handle chat ending from either customer or admin
 @socketio.on('end_chat')
 def handle_chat_end(data):
@@ -353,15 +370,8 @@ def handle_chat_end(data):
         db.session.add(chat_history)
         db.session.commit()
                 
-        # generate summary with Gemini
-        chat_text = "\n".join([f"{msg['type']}: {msg['message']}" for msg in chat_data['messages']])
-        prompt = f"Please provide a brief summary of this customer service chat:\n\n{chat_text}"
-                
-        response = chat_model.generate_content(prompt)
-        summary = response.text
-                
-        # update the chat history with summary
-        chat_history.chat_summary = summary
+        # the Gemini summary is added by a background job
+        enqueue('summarise_chat', {'chat_history_id': chat_history.id})
         db.session.commit()
                 
         emit('chat_history_saved', {
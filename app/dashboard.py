@@ -3,12 +3,12 @@ from flask_login import login_required, current_user
 from .forms import UpdatePersonalInformation, ChangePasswordForm, BillingAddressForm, PaymentMethodForm, ChangeEmailForm, Enable2FAForm, Verify2FAForm
 from .models import User, BillingAddress, PaymentInformation, PaymentType, Review, Cart, Order, UserVoucher, MailingList, Product, OrderItem
 from .roleDecorator import role_required
-from . import db, mail
+from .jobQueue import enqueue, backlog
+from . import db
 import secrets
 import os
 from PIL import Image
 from werkzeug.security import generate_password_hash, check_password_hash
-from flask_mail import Message
 
 dashboard = Blueprint('dashboard', __name__)
 # Profile page, settings page
@@ -569,15 +569,19 @@ def disable_2fa():
   return redirect(url_for('dashboard.security_settings'))
 
 def send_2fa_setup_email(user, code):
-  current_app.config['UPDATE_MAIL_CONFIG']('auth')
-  
   html_body = render_template('email/2fa_setup.html', user=user, code=code)
   
-  msg = Message(
-    'Set Up Two-Factor Authentication', 
-    sender=('Rewwwind Help', current_app.config['MAIL_USERNAME']), 
-    recipients=[user.email],
-    html=html_body
-  )
-  
-  mail.send(msg)
\ No newline at end of file
+  enqueue('send_email', {
+    'account': 'auth',
+    'sender_name': 'Rewwwind Help',
+    'subject': 'Set Up Two-Factor Authentication',
+    'recipients': [user.email],
+    'html': html_body
+  }, max_attempts=3)  # the code expires after 5 minutes
+
+# Background job backlog: queue depth, oldest waiting job and recent failures (see jobQueue.py)
+@dashboard.route('/jobs')
+@login_required
+@role_required(2, 3)
+def job_backlog():
+  return jsonify(backlog())
\ No newline at end of file
@@ -0,0 +1,208 @@
+from flask import current_app
+from multiprocessing import AuthenticationError
+from multiprocessing.connection import Listener, Connection, answer_challenge, deliver_challenge
+import os
+import queue
+import socket
+import threading
+import time
+
+import numpy as np
+
+from .clipModel import DOWNSCALE_SIZE, decode_image, encode_image, embed_pil_images, embed_texts, extract_image_embedding
+
+# Out-of-process embedding worker
+# One process owns the CLIP model and every web worker sends it uploaded images and search text over a local socket,
+# so the model is loaded once and concurrent queries are embedded together in micro-batches.
+# Run with: python -m app.embeddingWorker
+#
+# Wire format (raw bytes, nothing is unpickled): request = b'I' + image bytes or b'T' + utf-8 text,
+# reply = b'\x00' + float32 embedding or b'\x01' + error message.
+REQUEST_IMAGE = b'I'
+REQUEST_TEXT = b'T'
+REPLY_OK = b'\x00'
+REPLY_ERROR = b'\x01'
+
+# query images arrive already checked and downscaled by the web worker (PNG from encode_image)
+MAX_IMAGE_PIXELS = DOWNSCALE_SIZE * DOWNSCALE_SIZE
+MAX_IMAGE_BYTES = 4 * MAX_IMAGE_PIXELS
+
+def parse_address(address):
+    host, port = address.rsplit(':', 1)
+    return host, int(port)
+
+class EmbeddingJob:
+    def __init__(self, kind, payload):
+        self.kind = kind
+        self.payload = payload
+        self.reply = None
+        self.done = threading.Event()
+
+class EmbeddingWorker:
+    def __init__(self, address, authkey, max_batch=16, max_wait=0.01):
+        self.address = address
+        self.authkey = authkey
+        self.max_batch = max_batch
+        self.max_wait = max_wait  # seconds to wait for more uploads before running a batch
+        self.jobs = queue.Queue()
+
+    def serve_forever(self):
+        threading.Thread(target=self.batch_loop, name='embedding-batches', daemon=True).start()
+        with Listener(self.address, backlog=64, authkey=self.authkey) as listener:
+            print(f"Embedding worker listening on {self.address[0]}:{self.address[1]}")
+            while True:
+                try:
+                    conn = listener.accept()
+                except Exception as e:
+                    print(f"Rejected embedding worker connection: {e}")
+                    continue
+                threading.Thread(target=self.handle_connection, args=(conn,), daemon=True).start()
+
+    def handle_connection(self, conn):
+        with conn:
+            while True:
+                try:
+                    request = conn.recv_bytes()
+                except (EOFError, OSError):
+                    return
+                job = EmbeddingJob(request[:1], request[1:])
+                self.jobs.put(job)
+                job.done.wait()
+                conn.send_bytes(job.reply)
+
+    def next_batch(self):
+        batch = [self.jobs.get()]
+        deadline = time.monotonic() + self.max_wait
+        while len(batch) < self.max_batch:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(self.jobs.get(timeout=remaining))
+            except queue.Empty:
+                break
+        return batch
+
+    def batch_loop(self):
+        while True:
+            batch = self.next_batch()
+
+            # a broken upload only fails its own job, not the whole batch
+            images, decoded = [], []
+            texts, text_jobs = [], []
+            for job in batch:
+                try:
+                    if job.kind == REQUEST_IMAGE:
+                        images.append(decode_image(job.payload, max_bytes=MAX_IMAGE_BYTES, max_pixels=MAX_IMAGE_PIXELS))
+                        decoded.append(job)
+                    elif job.kind == REQUEST_TEXT:
+                        texts.append(job.payload.decode())
+                        text_jobs.append(job)
+                    else:
+                        raise ValueError(f"Unknown request type: {job.kind!r}")
+                except Exception as e:
+                    job.reply = REPLY_ERROR + str(e).encode()
+                    job.done.set()
+
+            # one forward pass per kind of input
+            self.run_batch(decoded, embed_pil_images, images)
+            self.run_batch(text_jobs, embed_texts, texts)
+
+    def run_batch(self, jobs, embed, inputs):
+        if not jobs:
+            return
+        try:
+            features = embed(inputs).astype(np.float32)
+            for job, row in zip(jobs, features):
+                job.reply = REPLY_OK + row.tobytes()
+        except Exception as e:
+            for job in jobs:
+                job.reply = REPLY_ERROR + str(e).encode()
+        for job in jobs:
+            job.done.set()
+
+class EmbeddingWorkerError(Exception):
+    # the worker answered with an error instead of an embedding
+    pass
+
+# what makes a query fall back to embedding inline
+WORKER_UNAVAILABLE = (OSError, EOFError, AuthenticationError, EmbeddingWorkerError)
+
+class TimeoutConnection(Connection):
+    # every receive, the authentication handshake included, gives up after timeout seconds
+    def __init__(self, handle, timeout):
+        super().__init__(handle)
+        self.timeout = timeout
+
+    def recv_bytes(self, maxlength=None):
+        if not self.poll(self.timeout):
+            raise TimeoutError(f"No reply from the embedding worker within {self.timeout}s")
+        return super().recv_bytes(maxlength)
+
+class EmbeddingClient:
+    def __init__(self, address, authkey, timeout=10):
+        self.address = address
+        self.authkey = authkey
+        self.timeout = timeout  # seconds, for connecting and for each reply
+
+    def connect(self):
+        # multiprocessing's Client() can't time out, a worker stuck with a full accept backlog would hang the request
+        sock = socket.create_connection(self.address, timeout=self.timeout)
+        sock.setblocking(True)
+        conn = TimeoutConnection(sock.detach(), self.timeout)
+        try:
+            answer_challenge(conn, self.authkey)
+            deliver_challenge(conn, self.authkey)
+        except BaseException:
+            conn.close()
+            raise
+        return conn
+
+    def embed(self, kind, payload):
+        with self.connect() as conn:
+            conn.send_bytes(kind + payload)
+            reply = conn.recv_bytes()
+        if reply[:1] != REPLY_OK:
+            raise EmbeddingWorkerError(reply[1:].decode(errors='replace'))
+        return np.frombuffer(reply[1:], dtype=np.float32)
+
+    def embed_image(self, image_bytes):
+        return self.embed(REQUEST_IMAGE, image_bytes)
+
+    def embed_text(self, text):
+        return self.embed(REQUEST_TEXT, text.encode())
+
+def worker_authkey():
+    return os.getenv('EMBEDDING_WORKER_KEY', '').encode()
+
+def worker_client(address):
+    return EmbeddingClient(parse_address(address), worker_authkey(), current_app.config['EMBEDDING_WORKER_TIMEOUT'])
+
+# Embedding for a decoded search query image (see decode_image), from the worker when one is configured
+def embed_query_image(image):
+    address = current_app.config['EMBEDDING_WORKER_ADDRESS']
+    if address:
+        try:
+            return worker_client(address).embed_image(encode_image(image))
+        except WORKER_UNAVAILABLE as e:
+            # worker down, unreachable, too slow or failing, fall back to embedding in this process
+            print(f"Embedding worker unavailable, embedding inline: {e}")
+    return extract_image_embedding(image)
+
+# Embedding for a text search query, in the same space as the image embeddings
+def embed_query_text(text):
+    address = current_app.config['EMBEDDING_WORKER_ADDRESS']
+    if address:
+        try:
+            return worker_client(address).embed_text(text)
+        except WORKER_UNAVAILABLE as e:
+            print(f"Embedding worker unavailable, embedding inline: {e}")
+    return embed_texts([text])[0]
+
+if __name__ == '__main__':
+    from dotenv import load_dotenv
+    load_dotenv()
+    address = os.getenv('EMBEDDING_WORKER_ADDRESS') or '127.0.0.1:6010'
+    if not worker_authkey():
+        raise SystemExit("Set EMBEDDING_WORKER_KEY before starting the embedding worker.")
+    EmbeddingWorker(parse_address(address), worker_authkey(), max_batch=int(os.getenv('EMBEDDING_WORKER_MAX_BATCH', '16'))).serve_forever()
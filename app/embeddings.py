@@ -0,0 +1,343 @@
+from flask import current_app
+import hashlib
+import json
+import os
+import threading
+
+import numpy as np
+from filelock import FileLock
+
+from .vectorIndex import build_index, normalise, quantise_matrix
+from .jobQueue import job
+
+EMBEDDING_MODEL = "openai/clip-vit-base-patch32"
+STORE_VERSION = 2  # bump when the on-disk layout changes, older caches are re-embedded
+
+# Persistent CLIP embedding store
+# <model>-<generation>-<pid>.npy holds one normalised embedding per row, <model>.json maps image content
+# hashes (sha256) to rows, so a restart with an unchanged catalog never has to run the model again.
+#
+# The matrix is memory-mapped, so every web worker shares the same pages instead of holding its own copy.
+# At float16/int8 precision each generation also gets its search codes (<matrix>.<precision>.npy, plus
+# <matrix>.int8-scales.npy), memory-mapped the same way, so quantised indexes are shared too.
+# Each save writes a new matrix file and bumps the generation in <model>.json; other workers
+# notice the new generation on their next search and remap (see reload_if_stale).
+# Writers (startup sync, the embedding jobs in every process) hold <model>.lock from reloading the latest generation
+# until the new one is published and the old matrices are removed, so no update is lost and no live matrix is deleted.
+class EmbeddingStore:
+    def __init__(self, folder, model_name=EMBEDDING_MODEL, precision='float32'):
+        self.folder = folder
+        self.model_name = model_name
+        self.slug = model_name.replace('/', '__')
+        self.index_path = os.path.join(folder, f"{self.slug}.json")
+        self.lock = FileLock(os.path.join(folder, f"{self.slug}.lock"))
+        self.precision = precision  # of the search codes saved with the matrix
+
+        self.generation = 0
+        self.matrix_file = None
+        self.index_mtime = None
+        self.matrix = np.zeros((0, 0), dtype=np.float32)
+        self.codes_files = {}  # {'precision', 'codes', 'scales'} of the current generation, empty at float32
+        self.codes = None  # quantised matrix rows (see vectorIndex.quantise_matrix), None until saved at this precision
+        self.scales = None  # int8 only, one per row
+        self.rows = {}  # sha256 -> row in matrix
+        self.images = {}  # image path -> {'sha256', 'mtime', 'size'}
+        self.products = {}  # product id -> [image paths]
+
+        if not os.path.exists(folder):
+            os.makedirs(folder)
+        self.load()
+
+    def index_stat(self):
+        try:
+            return os.stat(self.index_path).st_mtime_ns
+        except OSError:
+            return None
+
+    def load(self):
+        if not os.path.exists(self.index_path):
+            return False
+        try:
+            mtime = self.index_stat()
+            with open(self.index_path) as f:
+                index = json.load(f)
+            if index.get('model') != self.model_name or index.get('version') != STORE_VERSION:
+                return False
+            matrix = np.load(os.path.join(self.folder, index['matrix']), mmap_mode='r')
+            rows = index.get('rows', {})
+            if rows and max(rows.values()) >= matrix.shape[0]:
+                print("Embedding cache is inconsistent, rebuilding.")
+                return False
+            self.generation = index['generation']
+            self.matrix_file = index['matrix']
+            self.index_mtime = mtime
+            self.matrix = matrix
+            self.load_codes(index.get('codes') or {})
+            self.rows = rows
+            self.images = index.get('images', {})
+            self.products = {int(product_id): paths for product_id, paths in index.get('products', {}).items()}
+            return True
+        except Exception as e:
+            print(f"Failed to load embedding cache: {e}")
+            return False
+
+    def load_codes(self, codes_files):
+        self.codes_files = codes_files
+        self.codes = self.scales = None
+        if codes_files.get('precision') == self.precision:
+            self.codes = np.load(os.path.join(self.folder, codes_files['codes']), mmap_mode='r')
+            if codes_files.get('scales'):
+                self.scales = np.load(os.path.join(self.folder, codes_files['scales']), mmap_mode='r')
+
+    def reload_if_stale(self):
+        # a stat per call, the index is only re-read when another process published a new generation
+        mtime = self.index_stat()
+        if mtime is None or mtime == self.index_mtime:
+            return False
+        try:
+            with open(self.index_path) as f:
+                index = json.load(f)
+        except (OSError, ValueError):
+            return False
+        if (index.get('generation'), index.get('matrix')) == (self.generation, self.matrix_file):
+            self.index_mtime = mtime
+            return False
+        return self.load()
+
+    def save(self):
+        # write to temporary files first so a crash never leaves a half-written cache behind
+        # matrix files are never overwritten, other workers may still have the previous one mapped
+        generation = self.generation + 1
+        matrix_file = f"{self.slug}-{generation}-{os.getpid()}.npy"
+        matrix_path = os.path.join(self.folder, matrix_file)
+        self.write_array(matrix_file, np.ascontiguousarray(self.matrix, dtype=np.float32))
+        codes_files = self.save_codes(matrix_file)
+        with open(self.index_path + '.tmp', 'w') as f:
+            json.dump({
+                'model': self.model_name,
+                'version': STORE_VERSION,
+                'generation': generation,
+                'matrix': matrix_file,
+                'codes': codes_files,
+                'rows': self.rows,
+                'images': self.images,
+                'products': self.products
+            }, f)
+        os.replace(self.index_path + '.tmp', self.index_path)
+
+        # keep the matrix on disk rather than in process memory
+        self.generation = generation
+        self.matrix_file = matrix_file
+        self.index_mtime = self.index_stat()
+        self.matrix = np.load(matrix_path, mmap_mode='r')
+        self.load_codes(codes_files)
+        self.remove_stale_matrices()
+
+    def write_array(self, filename, array):
+        path = os.path.join(self.folder, filename)
+        with open(path + '.tmp', 'wb') as f:
+            np.save(f, array)
+        os.replace(path + '.tmp', path)
+
+    def save_codes(self, matrix_file):
+        # the generation's quantised search codes, next to its matrix
+        if self.precision == 'float32':
+            return {}
+        codes, scales = quantise_matrix(self.matrix, self.precision)
+        stem = matrix_file[:-len('.npy')]
+        codes_files = {'precision': self.precision, 'codes': f"{stem}.{self.precision}.npy", 'scales': None}
+        self.write_array(codes_files['codes'], codes)
+        if scales is not None:
+            codes_files['scales'] = f"{stem}.{self.precision}-scales.npy"
+            self.write_array(codes_files['scales'], scales)
+        return codes_files
+
+    def ensure_codes(self):
+        # a cache saved before codes existed, or at another precision, gets them once (as a new generation)
+        if self.precision == 'float32' or self.codes is not None or not self.rows:
+            return False
+        with self.lock:
+            self.reload_if_stale()
+            if self.codes is None:
+                self.save()
+        return True
+
+    def remove_stale_matrices(self):
+        current = {self.matrix_file, self.codes_files.get('codes'), self.codes_files.get('scales')}
+        for filename in os.listdir(self.folder):
+            if filename.startswith(f"{self.slug}-") and filename.endswith('.npy') and filename not in current:
+                try:
+                    os.remove(os.path.join(self.folder, filename))
+                except OSError:
+                    # still mapped by another process (Windows), removed on a later save
+                    pass
+
+    def image_hash(self, image_path, full_path):
+        # only re-read the file when its size or modification time changed
+        stat = os.stat(full_path)
+        cached = self.images.get(image_path)
+        if cached and cached['mtime'] == stat.st_mtime_ns and cached['size'] == stat.st_size:
+            return cached['sha256']
+
+        sha = hashlib.sha256()
+        with open(full_path, 'rb') as f:
+            for chunk in iter(lambda: f.read(1024 * 1024), b''):
+                sha.update(chunk)
+        self.images[image_path] = {'sha256': sha.hexdigest(), 'mtime': stat.st_mtime_ns, 'size': stat.st_size}
+        return self.images[image_path]['sha256']
+
+    def sync(self, product_images, embed_images):
+        """
+        Bring the whole store in line with product_images ({product id: {image path: full path on disk}}).
+        embed_images is called with the full paths of new or changed images only, and returns one row per path.
+        """
+        with self.lock:
+            self.reload_if_stale()
+            self.products = {}
+            full_paths = {}
+            for product_id, image_files in product_images.items():
+                self.products[product_id] = list(image_files)
+                full_paths.update(image_files)
+            return self.apply(full_paths, embed_images)
+
+    def upsert(self, product_id, image_files, embed_images):
+        # (re-)embed a single product, images it no longer uses are dropped
+        # start from the latest published generation so another worker's update isn't lost
+        with self.lock:
+            self.reload_if_stale()
+            self.products[product_id] = list(image_files)
+            return self.apply(image_files, embed_images)
+
+    def remove(self, product_id):
+        with self.lock:
+            self.reload_if_stale()
+            if self.products.pop(product_id, None) is None:
+                return False
+            return self.apply({}, None)
+
+    def apply(self, full_paths, embed_images):
+        previous = {path: entry['sha256'] for path, entry in self.images.items()}
+        for image_path, full_path in full_paths.items():
+            self.image_hash(image_path, full_path)
+
+        live_paths = dict.fromkeys(path for paths in self.products.values() for path in paths if path in self.images)
+        self.images = {path: self.images[path] for path in live_paths}
+        hashes = {path: self.images[path]['sha256'] for path in live_paths}
+
+        # one forward pass per unique content, duplicates share a row
+        missing = {}
+        for image_path, sha in hashes.items():
+            if sha not in self.rows and sha not in missing:
+                missing[sha] = full_paths[image_path]
+
+        used = list(dict.fromkeys(hashes.values()))
+        if not missing and previous == hashes and len(used) == len(self.rows):
+            return False
+
+        new_embeddings = None
+        if missing:
+            print(f"Embedding {len(missing)} new or changed image(s)...")
+            new_embeddings = normalise(embed_images(list(missing.values())))
+
+        # rebuild the matrix from rows still in use + new rows, dropping orphaned embeddings
+        parts = []
+        rows = {}
+        kept = [sha for sha in used if sha in self.rows]
+        if kept:
+            parts.append(np.asarray(self.matrix[[self.rows[sha] for sha in kept]], dtype=np.float32))
+            rows.update({sha: i for i, sha in enumerate(kept)})
+        if new_embeddings is not None:
+            parts.append(new_embeddings)
+            rows.update({sha: len(kept) + i for i, sha in enumerate(missing)})
+
+        self.matrix = np.vstack(parts) if parts else np.zeros((0, 0), dtype=np.float32)
+        self.rows = rows
+        self.save()
+        return True
+
+    def get(self, image_path):
+        entry = self.images.get(image_path)
+        if not entry or entry['sha256'] not in self.rows:
+            return None
+        return np.asarray(self.matrix[self.rows[entry['sha256']]])
+
+    def image_products(self):
+        # image path -> owning product id, so search results never need a LIKE lookup on Product.images
+        return {path: product_id for product_id, paths in self.products.items() for path in paths}
+
+    def row_products(self):
+        # product ids owning each matrix row, a row is shared when several images have the same content
+        row_products = [[] for _ in range(self.matrix.shape[0])]
+        for path, product_id in self.image_products().items():
+            entry = self.images.get(path)
+            if entry and entry['sha256'] in self.rows and product_id not in row_products[self.rows[entry['sha256']]]:
+                row_products[self.rows[entry['sha256']]].append(product_id)
+        return row_products
+
+def get_store():
+    store = current_app.config.get('EMBEDDING_STORE')
+    if store is None:
+        store = EmbeddingStore(current_app.config['EMBEDDING_CACHE_FOLDER'], EMBEDDING_MODEL, current_app.config['VECTOR_INDEX_PRECISION'])
+        current_app.config['EMBEDDING_STORE'] = store
+    return store
+
+def refresh_index():
+    # index rows are the shared store matrix (and its codes), labelled with the product ids owning each row
+    store = get_store()
+    store.ensure_codes()
+    index = build_index(
+        store.matrix, store.row_products(), normalised=True,
+        ivf_threshold=current_app.config['VECTOR_INDEX_IVF_THRESHOLD'],
+        n_probe=current_app.config['VECTOR_INDEX_NPROBE'],
+        precision=store.precision,
+        codes=store.codes,
+        scales=store.scales
+    )
+    current_app.config['PRODUCT_EMBEDDINGS'] = index
+    current_app.config['PRODUCT_EMBEDDINGS_GENERATION'] = (store.generation, store.matrix_file)
+    return index
+
+def get_index():
+    # remap when another worker published a newer generation since the index was built
+    store = get_store()
+    store.reload_if_stale()
+    if current_app.config.get('PRODUCT_EMBEDDINGS_GENERATION') != (store.generation, store.matrix_file):
+        return refresh_index()
+    return current_app.config['PRODUCT_EMBEDDINGS']
+
+def product_image_files(product):
+    image_files = {}
+    for image_path in product.images or []:
+        full_image_path = os.path.join(current_app.static_folder, 'media', 'uploads', image_path)
+        if os.path.exists(full_image_path):
+            image_files[image_path] = full_image_path
+    return image_files
+
+# Incremental updates, run as background jobs after product adds, updates and deletes
+def upsert(product):
+    from .clipModel import embed_images
+    store = get_store()
+    if store.upsert(product.id, product_image_files(product), embed_images):
+        refresh_index()
+
+def remove(product_id):
+    store = get_store()
+    if store.remove(product_id):
+        refresh_index()
+
+# job threads in this process share the store object, one update at a time (other processes wait on store.lock)
+_update_lock = threading.Lock()
+
+@job('embed_product')
+def embed_product(product_id):
+    from .models import Product
+    product = Product.query.get(product_id)
+    if product is None:
+        return
+    with _update_lock:
+        upsert(product)
+
+@job('remove_product_embedding')
+def remove_product_embedding(product_id):
+    with _update_lock:
+        remove(product_id)
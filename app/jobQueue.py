@@ -0,0 +1,194 @@
+from flask import current_app
+from sqlalchemy import update, and_, or_, func, event, inspect
+from sqlalchemy.orm import Session
+from datetime import datetime, timedelta
+import threading
+import traceback
+
+from . import db
+from .models import Job
+
+# Background job queue
+# Slow side effects (emails, Cloudinary uploads, chat summaries, embeddings) are stored as rows in the jobs table
+# and run by worker threads, so the request that causes them doesn't wait for the external service.
+# Every process started with create_app runs JOB_WORKERS threads. A job is claimed with a conditional UPDATE,
+# so it runs once however many processes are polling. Failures are retried with exponential backoff
+# (JOB_RETRY_SECONDS, doubled per attempt) up to max_attempts, then marked 'failed' with the last error.
+# A finished or failed job's payload is cleared (it can hold rendered emails with 2FA codes and reset links),
+# the rows themselves are pruned after JOB_RETENTION seconds.
+# Jobs left 'running' by a process that died are picked up again after JOB_TIMEOUT seconds.
+# With JOB_WORKERS=0 (e.g. scripts) there are no workers, jobs run as soon as they are committed and failures are retried straight away.
+JOB_STATUSES = ('queued', 'running', 'done', 'failed')
+JOB_HANDLERS = {}
+
+_wake = threading.Event()
+_last_prune = None
+
+def job(name):
+    # registers a handler, it is called with the job's payload as keyword arguments inside an app context
+    def register(handler):
+        JOB_HANDLERS[name] = handler
+        return handler
+    return register
+
+def enqueue(name, payload=None, max_attempts=None):
+    """
+    Queue a job, payload has to be JSON serialisable (ids, not model instances).
+    The job is only added to the session: the caller's next commit saves it together with the caller's changes,
+    and a rollback drops it.
+    """
+    if name not in JOB_HANDLERS:
+        raise ValueError(f"Unknown job: {name}")
+    new_job = Job(name=name, payload=payload or {}, max_attempts=max_attempts or current_app.config['JOB_MAX_ATTEMPTS'])
+    db.session.add(new_job)
+    db.session.info.setdefault('queued_jobs', []).append(new_job)
+    return new_job
+
+def claim(job_id=None):
+    # the next due job (or the given one), None if there is none or another worker got it first
+    now = datetime.now()
+    stale = now - timedelta(seconds=current_app.config['JOB_TIMEOUT'])
+    claimable = or_(
+        and_(Job.status == 'queued', Job.run_after <= now),
+        and_(Job.status == 'running', Job.locked_at < stale)
+    )
+    if job_id is None:
+        job_id = db.session.query(Job.id).filter(claimable).order_by(Job.run_after, Job.id).limit(1).scalar()
+        if job_id is None:
+            return None
+    result = db.session.execute(
+        update(Job)
+        .where(Job.id == job_id, claimable)
+        .values(status='running', locked_at=now, attempts=Job.attempts + 1)
+        .execution_options(synchronize_session=False)
+    )
+    db.session.commit()
+    if result.rowcount != 1:
+        return None
+    return db.session.get(Job, job_id, populate_existing=True)
+
+def run_inline(job_ids):
+    # in a fresh app context, so the job and its bookkeeping use their own session and not the caller's
+    with current_app.app_context():
+        for job_id in job_ids:
+            claimed = claim(job_id)
+            while claimed is not None:
+                run_job(claimed)
+                claimed = claim(job_id)  # None once the job is done or has failed for good
+
+def run_job(claimed):
+    job_id, name, payload = claimed.id, claimed.name, claimed.payload or {}
+    try:
+        handler = JOB_HANDLERS.get(name)
+        if handler is None:
+            raise LookupError(f"No handler registered for job {name}")
+        handler(**payload)
+    except Exception as e:
+        db.session.rollback()
+        claimed = db.session.get(Job, job_id)
+        claimed.last_error = ''.join(traceback.format_exception(e))[-4000:]
+        claimed.locked_at = None
+        if claimed.attempts >= claimed.max_attempts:
+            claimed.status = 'failed'
+            claimed.payload = {}
+            claimed.finished_at = datetime.now()
+            print(f"Job {job_id} ({name}) failed after {claimed.attempts} attempts: {e}")
+        else:
+            # without workers nothing would pick a delayed retry up, so it runs again straight away
+            delay = current_app.config['JOB_RETRY_SECONDS'] * 2 ** (claimed.attempts - 1) if current_app.config['JOB_WORKERS'] else 0
+            claimed.status = 'queued'
+            claimed.run_after = datetime.now() + timedelta(seconds=delay)
+            print(f"Job {job_id} ({name}) failed, retrying in {delay}s: {e}")
+    else:
+        claimed = db.session.get(Job, job_id)
+        claimed.status = 'done'
+        claimed.payload = {}
+        claimed.locked_at = None
+        claimed.finished_at = datetime.now()
+    db.session.commit()
+
+def prune():
+    # finished and failed jobs are kept for JOB_RETENTION seconds
+    global _last_prune
+    now = datetime.now()
+    if _last_prune is not None and now - _last_prune < timedelta(hours=1):
+        return
+    _last_prune = now
+    cutoff = now - timedelta(seconds=current_app.config['JOB_RETENTION'])
+    Job.query.filter(Job.status.in_(['done', 'failed']), Job.finished_at < cutoff).delete(synchronize_session=False)
+    db.session.commit()
+
+def work(app):
+    while True:
+        with app.app_context():
+            try:
+                claimed = claim()
+                if claimed is not None:
+                    run_job(claimed)
+                    continue
+                prune()
+            except Exception as e:
+                db.session.rollback()
+                print(f"Job worker error: {e}")
+        # woken early when jobs are committed in this process, jobs queued by other processes wait for the next poll
+        _wake.wait(app.config['JOB_POLL_SECONDS'])
+        _wake.clear()
+
+def start_workers(app):
+    for i in range(app.config['JOB_WORKERS']):
+        threading.Thread(target=work, args=(app,), name=f"job-worker-{i}", daemon=True).start()
+
+# wake the workers once queued jobs are committed
+@event.listens_for(Session, 'after_commit')
+def start_queued_jobs(db_session):
+    queued = db_session.info.pop('queued_jobs', None)
+    if not queued:
+        return
+    if current_app.config['JOB_WORKERS']:
+        _wake.set()
+    else:
+        # the identity is read without touching the database, the committing session can't run SQL here
+        run_inline([inspect(queued_job).identity[0] for queued_job in queued if inspect(queued_job).identity])
+
+@event.listens_for(Session, 'after_soft_rollback')
+def discard_queued_jobs(db_session, previous_transaction):
+    db_session.info.pop('queued_jobs', None)
+
+def backlog():
+    # queue depth per status and job, how long the oldest queued job has waited, and the latest failures
+    now = datetime.now()
+    counts = dict(db.session.query(Job.status, func.count(Job.id)).group_by(Job.status).all())
+    queued = dict(db.session.query(Job.name, func.count(Job.id)).filter(Job.status == 'queued').group_by(Job.name).all())
+    oldest = db.session.query(func.min(Job.created_at)).filter(Job.status == 'queued').scalar()
+    failures = Job.query.filter(Job.status == 'failed').order_by(Job.finished_at.desc()).limit(20)
+    return {
+        'counts': {status: counts.get(status, 0) for status in JOB_STATUSES},
+        'queued_by_job': queued,
+        'oldest_queued_seconds': round((now - oldest).total_seconds()) if oldest else None,
+        'recent_failures': [{
+            'id': failed.id,
+            'name': failed.name,
+            'attempts': failed.attempts,
+            'error': ((failed.last_error or '').strip().splitlines() or [''])[-1],
+            'finished_at': failed.finished_at.isoformat() if failed.finished_at else None
+        } for failed in failures],
+        'workers': current_app.config['JOB_WORKERS']
+    }
+
+# shared jobs
+
+_mail_lock = threading.Lock()
+
+@job('send_email')
+def send_email(account, sender_name, subject, recipients, html):
+    from flask_mail import Message
+    from . import mail
+    # UPDATE_MAIL_CONFIG switches the whole app's mail account, so sends from this process go one at a time
+    with _mail_lock:
+        current_app.config['UPDATE_MAIL_CONFIG'](account)
+        mail.send(Message(
+            subject,
+            sender=(sender_name, current_app.config['MAIL_USERNAME']),
+            recipients=recipients,
+            html=html
+        ))
@@ -0,0 +1,86 @@
+from sqlalchemy import and_, or_, func
+import base64
+import json
+
+from .models import Product
+
+# Keyset (cursor) pagination for product listings
+# Rather than OFFSET, which makes the database walk past every earlier row, the next page continues
+# from the sort values of the last product shown: WHERE (sort keys, id) > (last values, last id).
+# Every page then costs the same as the first one. Numbered page links can still jump with an offset.
+#
+# sort_keys is a list of (name, expression, descending), applied in order before the id column (Product.id unless given).
+# Keys that can be NULL are compared as coalesce(key, 0), NOT NULL columns are left as they are so their indexes are used.
+
+class KeysetPage:
+    def __init__(self, items, next_cursor, page, per_page):
+        self.items = items
+        self.next_cursor = next_cursor
+        self.page = page
+        self.per_page = per_page
+
+    @property
+    def has_next(self):
+        return self.next_cursor is not None
+
+    def __iter__(self):
+        return iter(self.items)
+
+def sort_signature(sort_keys):
+    # a cursor is only valid for the ordering it was made with
+    return ','.join(f"{name}:{'desc' if descending else 'asc'}" for name, _, descending in sort_keys)
+
+def encode_cursor(sort_keys, values, last_id):
+    payload = json.dumps({'s': sort_signature(sort_keys), 'v': values, 'id': last_id}, separators=(',', ':'))
+    return base64.urlsafe_b64encode(payload.encode()).decode().rstrip('=')
+
+def decode_cursor(sort_keys, cursor):
+    try:
+        payload = json.loads(base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)))
+        if payload['s'] != sort_signature(sort_keys) or len(payload['v']) != len(sort_keys):
+            return None
+        return payload['v'], int(payload['id'])
+    except (ValueError, KeyError, TypeError):
+        return None
+
+def after(sort_keys, expressions, values, last_id, id_column=Product.id):
+    # (a, b, id) > (x, y, last id) in each key's own direction, written out for SQLite
+    keys = [(expression, descending) for expression, (_, _, descending) in zip(expressions, sort_keys)] + [(id_column, False)]
+    values = list(values) + [last_id]
+    clauses = []
+    for i, (expression, descending) in enumerate(keys):
+        equal = [keys[j][0] == values[j] for j in range(i)]
+        beyond = expression < values[i] if descending else expression > values[i]
+        clauses.append(and_(*equal, beyond))
+    return or_(*clauses)
+
+def nullable(expression):
+    # columns know whether they are NOT NULL, anything else (CASE, functions) might be NULL
+    column = getattr(expression, 'expression', expression)
+    return getattr(column, 'nullable', True)
+
+def keyset_page(query, sort_keys, per_page, cursor=None, page=1, id_column=Product.id):
+    """
+    Fetch one page of query. With a valid cursor the page continues after it,
+    otherwise it starts at (page - 1) * per_page.
+    """
+    # NULLs can't be compared, they sort as 0
+    expressions = [func.coalesce(expression, 0) if nullable(expression) else expression for _, expression, _ in sort_keys]
+    ordering = [expression.desc() if descending else expression.asc() for expression, (_, _, descending) in zip(expressions, sort_keys)]
+    # rows come back as (item, *sort values, id)
+    query = query.add_columns(*expressions, id_column).order_by(None).order_by(*ordering, id_column)
+
+    position = decode_cursor(sort_keys, cursor) if cursor else None
+    if position is not None:
+        query = query.filter(after(sort_keys, expressions, *position, id_column=id_column))
+    else:
+        query = query.offset((max(page, 1) - 1) * per_page)
+
+    # one extra row tells whether there is a next page, without counting
+    rows = query.limit(per_page + 1).all()
+    next_cursor = None
+    if len(rows) > per_page:
+        rows = rows[:per_page]
+        last = rows[-1]
+        next_cursor = encode_cursor(sort_keys, list(last[1:-1]), last[-1])
+    return KeysetPage([row[0] for row in rows], next_cursor, page, per_page)
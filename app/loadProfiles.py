@@ -0,0 +1,63 @@
+from flask import g, has_request_context, request
+from sqlalchemy import event
+from sqlalchemy.orm import joinedload, selectinload
+
+from . import db
+from .models import Product, Review
+
+# Named eager-loading profiles
+# Relationships are lazy by default, so every product card that touches product.category or product.subcategories
+# costs another query. Listings load them up front with these, e.g. query.options(*load_profile('product_list')).
+# Conditions are always loaded with a selectin query (see Product.condition_rows).
+LOAD_PROFILES = {
+    # storefront grids and the wishlist: category name (review count and rating are columns on the product)
+    'product_list': (joinedload(Product.category),),
+    # admin products table: category and genre columns
+    'product_admin_list': (joinedload(Product.category), selectinload(Product.subcategories)),
+    # product page: category
+    'product_detail': (joinedload(Product.category),),
+    # a page of reviews with their authors
+    'review_list': (joinedload(Review.user),)
+}
+
+def load_profile(name):
+    return LOAD_PROFILES[name]
+
+# Query budget per route
+# Counts the SQL statements each request runs, adds an X-Query-Count header and prints a warning
+# when a route goes over its budget, so an N+1 regression shows up in the development server log.
+# Enabled with QUERY_BUDGET_CHECK=1 in the environment, tests/test_query_budgets.py fails when a route goes over.
+QUERY_BUDGETS = {
+    'productPagination.product_pagination': 12,
+    'productPagination.product_specials': 12,
+    'productPagination.product_staff': 12,
+    'productPagination.product_feed': 12,
+    'productPagination.product_detail': 10,
+    'manageProducts.products_listing': 14,
+    'wishlist.favourites': 10
+}
+
+def count_query(connection, cursor, statement, parameters, context, executemany):
+    if has_request_context() and 'query_count' in g:
+        g.query_count += 1
+
+def register_query_budget(app):
+    if not app.config.get('QUERY_BUDGET_CHECK'):
+        return
+
+    # only this app's engine is counted, and only when the check is on
+    with app.app_context():
+        event.listen(db.engine, 'before_cursor_execute', count_query)
+
+    @app.before_request
+    def start_query_count():
+        g.query_count = 0
+
+    @app.after_request
+    def check_query_count(response):
+        count = g.get('query_count', 0)
+        response.headers['X-Query-Count'] = str(count)
+        budget = QUERY_BUDGETS.get(request.endpoint)
+        if budget is not None and count > budget:
+            print(f"Query budget exceeded: {request.endpoint} ran {count} queries (budget {budget}) for {request.full_path}")
+        return response
@@ -1,11 +1,10 @@
 from flask import Blueprint, render_template, redirect, url_for, request, flash, abort, make_response
 from flask_login import login_required, current_user
 from .roleDecorator import role_required
-from .models import Order, Product
+from .models import Order, ProductCondition
 from .forms import UpdateOrderForm
 from . import db
-from sqlalchemy import desc, asc, cast, Float
-from sqlalchemy.orm.attributes import flag_modified
+from sqlalchemy import desc, asc, cast, Float, update, func
 from datetime import datetime, timedelta
 from fpdf import FPDF
 from math import ceil
@@ -123,30 +122,31 @@ def update_order(order_id):
   form = UpdateOrderForm()
 
   if form.validate_on_submit():
-    if form.approved.data.title() in ['Approved', 'Rejected']:
-      if form.approved.data.title() == 'Not Approved':
-        order.status = 'Pending'
-      else:
-        order.status = form.approved.data.title()
-    
-    db.session.commit()
+    if form.approved.data.title() == 'Approved':
+      # claim the transition with a conditional UPDATE, so of two concurrent approvals only one takes stock
+      claimed = db.session.execute(
+        update(Order)
+        .where(Order.id == order.id, Order.status != 'Approved')
+        .values(status='Approved', approval_date=func.now())
+        .execution_options(synchronize_session=False)
+      ).rowcount == 1
 
-    order.update_approval()
-    db.session.commit()
+      # stock is taken in the same transaction, one short item rolls back the whole approval
+      if claimed:
+        out_of_stock = []
+        for i in order.order_items:
+          if not ProductCondition.take_stock(i.product_id, i.product_condition['condition'], i.quantity):
+            out_of_stock.append(f"{i.product.name} ({i.product_condition['condition']})")
+        if out_of_stock:
+          db.session.rollback()
+          flash(f"Order was not approved, not enough stock left for: {', '.join(out_of_stock)}", "error")
+          return redirect(url_for('manageOrders.orders_listing'))
+      db.session.commit()
 
-    if order.status == 'Approved':
-      for i in order.order_items:
-        product = Product.query.filter(Product.id==i.product_id).first()
-        sel_idx = next(
-          (index for index, condition in enumerate(product.conditions) if condition['condition'] == i.product_condition['condition']),
-          None
-        )
-        product.conditions[sel_idx]['stock'] -= i.quantity
-        print(product.conditions[sel_idx]['stock'])
-        flag_modified(product, 'conditions')
-        db.session.commit()
+    elif form.approved.data.title() == 'Rejected':
+      order.status = 'Rejected'
+      order.update_approval()
 
-    
     flash("Order was updated successfully!", "success")
 
   return redirect(url_for('manageOrders.orders_listing'))
@@ -1,7 +1,7 @@
 from werkzeug.utils import secure_filename
 from flask import Blueprint, render_template, redirect, url_for, request, jsonify, flash, current_app, session
 from flask_login import login_required, current_user
-from sqlalchemy import cast, Integer, func
+from sqlalchemy import func
 from sqlalchemy.orm.attributes import flag_modified
 from sqlalchemy.dialects.postgresql import JSON
 from .roleDecorator import role_required
@@ -9,6 +9,10 @@ from .forms import AddProductForm, DeleteProductForm, AddProductFormData #, Edit
 from .models import Product, Category, SubCategory, ProductSubCategory, OrderItem
 from . import db
 from . import cloudinary
+from .productSearch import search_products
+from .taxonomy import get_taxonomy
+from .loadProfiles import load_profile
+from .jobQueue import job, enqueue
 import cloudinary.uploader
 import os
 
@@ -19,22 +23,23 @@ import shelve
 manageProducts = Blueprint('manageProducts', __name__)
 
 # Products page
-def pagination(products):
-    # count products
-    total_products = len(products)
+LOW_STOCK = 10  # a product has limited stock (and gets a warning) when this many or fewer are left across its conditions
 
-    # count warnings (low stock)
-    total_warnings = sum(
-        1 for product in products
-        if any(condition.get('stock') <= 10 for condition in product.conditions)
-    )
+def low_stock_warnings():
+    # products at or under LOW_STOCK, one count over a range scan of the total_stock index
+    return db.session.query(func.count(Product.id)).filter(Product.total_stock <= LOW_STOCK).scalar()
+
+def pagination():
+    # count warnings (low stock), the product count below follows the filters
+    total_warnings = low_stock_warnings()
 
     products_query = Product.query
 
     # search logic
     search_query = request.args.get('q', '', type=str)
+    search_order = []
     if search_query:
-        products_query = Product.query.filter(Product.name.ilike(f"%{search_query}%"))
+        products_query, search_order = search_products(products_query, search_query)
     
     # filter logic
     category_filter = request.args.get('type', '', type=str)
@@ -69,35 +74,33 @@ def pagination(products):
         else:
             products_query = products_query.filter(Product.is_featured_staff)
 
+    # total_stock is an indexed column kept in step with conditions
     if stock_filter:
         if 'limited' in stock_filter:
-            products_query = products_query.filter(cast(Product.conditions[0]['stock'], Integer) <= 10)
+            products_query = products_query.filter(Product.total_stock <= LOW_STOCK)
         elif 'plenty' in stock_filter:
-            products_query = products_query.filter(cast(Product.conditions[0]['stock'], Integer) > 10)
+            products_query = products_query.filter(Product.total_stock > LOW_STOCK)
         elif 'no' in stock_filter:
-            products_query = products_query.filter(cast(Product.conditions[0]['stock'], Integer) == 0)
+            products_query = products_query.filter(Product.total_stock == 0)
         elif 'lowest' in stock_filter:
-            products_query = products_query.order_by(cast(Product.conditions[0]['stock'], Integer).asc())
+            products_query = products_query.order_by(Product.total_stock.asc())
         else:
-            products_query = products_query.order_by(cast(Product.conditions[0]['stock'], Integer).desc())
+            products_query = products_query.order_by(Product.total_stock.desc())
 
     # pagination logic
     page = request.args.get('page', 1, type=int)
     per_page = 10
 
     total_products = products_query.count()
-    products = products_query.order_by(Product.id).paginate(page=page, per_page=per_page)
+    products = products_query.options(*load_profile('product_admin_list')).order_by(*search_order, Product.id).paginate(page=page, per_page=per_page)
 
     total_pages = ceil(total_products / per_page)
 
     # filter options
-    categories = Category.query.all()[:8]
-    category_choices = [(category.category_name.lower(), category.category_name) for category in categories]
+    taxonomy = get_taxonomy()
+    category_choices = [(name.lower(), name) for _, name in taxonomy.categories[:8]]
 
-    subcategories = SubCategory.query.all()
-    if category_filter:
-        subcategories = SubCategory.query.join(Category).filter(Category.category_name == category_filter.title())
-    subcategory_choices = [(subcategory.subcategory_name.lower(), subcategory.subcategory_name) for subcategory in subcategories]
+    subcategory_choices = [(name.lower(), name) for _, name, _ in taxonomy.subcategories_of(category_filter)]
 
     featured_choices = [
         ('special', 'Special'),
@@ -118,10 +121,9 @@ def pagination(products):
 @login_required
 @role_required(2, 3)
 def products_listing():
-    products = Product.query.all()
     deleteForm = DeleteProductForm()
 
-    products, total_products, total_warnings, total_pages, page, search_query, category_filter, subcategory_filter, featured_filter, stock_filter, category_choices, subcategory_choices, match_req, featured_choices, stock_choices = pagination(products)
+    products, total_products, total_warnings, total_pages, page, search_query, category_filter, subcategory_filter, featured_filter, stock_filter, category_choices, subcategory_choices, match_req, featured_choices, stock_choices = pagination()
     
     return render_template(
         "dashboard/manageProducts/products.html", 
@@ -129,6 +131,7 @@ def products_listing():
         products=products, 
         total_products=total_products, 
         total_warnings=total_warnings, 
+        low_stock=LOW_STOCK,
         deleteForm=deleteForm, 
         total_pages=total_pages, 
         current_page=page, 
@@ -144,6 +147,15 @@ def products_listing():
         stock_choices=stock_choices
         ) #, datetime=datetime
 
+# background jobs for Cloudinary (see jobQueue.py)
+@job('cloudinary_upload')
+def cloudinary_upload(file_path, public_id):
+    cloudinary.uploader.upload(file_path, public_id=public_id)
+
+@job('cloudinary_destroy')
+def cloudinary_destroy(public_id):
+    cloudinary.uploader.destroy(public_id)
+
 # uploads folder cleaning logic + crosscheck with cloudinary
 def clean_uploads_folder():
     used_images = set()
@@ -161,10 +173,11 @@ def clean_uploads_folder():
         file_path = os.path.join(uploads_folder, filename)
         try:
             os.remove(file_path)
-            cloudinary.uploader.destroy(filename.split('.')[0])
+            enqueue('cloudinary_destroy', {'public_id': filename.split('.')[0]})
             print(f"Deleted unused file: {filename}")
         except Exception as e:
             print(f"Error deleting file {filename}: {e}")
+    db.session.commit()
 
 @manageProducts.route('/manage-products/add-product', methods=['GET', 'POST'])
 @login_required
@@ -241,14 +254,9 @@ def add_product():
                             return jsonify({'error': True, 'message': "One or more images exceed the 5MB size limit. Please upload smaller images."})
 
                         secure_name = secure_filename(file.filename)
-                        cloudinary.uploader.upload(
-                            file,
-                            public_id=secure_name.split('.')[0]
-                        )
                         uploaded_file_urls.append(secure_name)
 
                         # to save on cloudinary credits, cross-check with local storage
-                        file.seek(0)
                         upload_folder = current_app.config['UPLOAD_FOLDER']
                         file_path = os.path.join(upload_folder, secure_name)
                         file.save(file_path)
@@ -286,9 +294,11 @@ def add_product():
                 # Set a session flag to prevent immediate re-saving
                 session['product_added'] = True
 
-                from .productPagination import precompute_product_embeddings
-                product_embeddings = precompute_product_embeddings()
-                current_app.config['PRODUCT_EMBEDDINGS'] = product_embeddings
+                # the local copies are uploaded to Cloudinary and only the new product's images are embedded, in the background
+                for image in uploaded_file_urls:
+                    enqueue('cloudinary_upload', {'file_path': os.path.join(current_app.config['UPLOAD_FOLDER'], image), 'public_id': image.split('.')[0]})
+                enqueue('embed_product', {'product_id': new_product.id})
+                db.session.commit()
 
                 # Return a success response
                 flash("The product has been added successfully.", "success")
@@ -415,14 +425,9 @@ def update_product(product_id):
                         return jsonify({'error': True, 'message': "One or more images exceed the 5MB size limit. Please upload smaller images."})
 
                     secure_name = secure_filename(file.filename)
-                    cloudinary.uploader.upload(
-                        file,
-                        public_id=secure_name.split('.')[0]
-                    )
                     uploaded_file_urls.append(secure_name)
 
                     # to save on cloudinary credits, cross-check with local storage
-                    file.seek(0)
                     upload_folder = current_app.config['UPLOAD_FOLDER']
                     file_path = os.path.join(upload_folder, secure_name)
                     file.save(file_path)
@@ -438,10 +443,13 @@ def update_product(product_id):
             product.image_thumbnail = product.images[int(form.productThumbnail.data)]
 
             # print(vars(product))
-            from .productPagination import precompute_product_embeddings
-            product_embeddings = precompute_product_embeddings()
-            current_app.config['PRODUCT_EMBEDDINGS'] = product_embeddings
             
+            # the local copies are uploaded to Cloudinary and the images embedded in the background,
+            # the jobs are committed with the product
+            for image in uploaded_file_urls:
+                enqueue('cloudinary_upload', {'file_path': os.path.join(current_app.config['UPLOAD_FOLDER'], image), 'public_id': image.split('.')[0]})
+            enqueue('embed_product', {'product_id': product.id})
+
             # Commit changes
             db.session.commit()
             flash("The product has been updated successfully.", "success")
@@ -462,10 +470,9 @@ def update_product(product_id):
 @login_required
 @role_required(2, 3)
 def delete_product():
-    products = Product.query.all()
     clean_uploads_folder()
 
-    products, total_products, total_warnings, total_pages, page, search_query, category_filter, subcategory_filter, featured_filter, stock_filter, category_choices, subcategory_choices, match_req, featured_choices, stock_choices = pagination(products)
+    products, total_products, total_warnings, total_pages, page, search_query, category_filter, subcategory_filter, featured_filter, stock_filter, category_choices, subcategory_choices, match_req, featured_choices, stock_choices = pagination()
     deleteForm = DeleteProductForm()
 
     if OrderItem.query.filter(OrderItem.product_id==deleteForm.productID.data).first():
@@ -476,6 +483,7 @@ def delete_product():
         product_to_delete = Product.query.get(id)
         if product_to_delete:
             db.session.delete(product_to_delete)
+            enqueue('remove_product_embedding', {'product_id': product_to_delete.id})
             db.session.commit()
             flash("The product has been removed successfully.", "success")
 
@@ -487,6 +495,7 @@ def delete_product():
         products=products, 
         total_products=total_products, 
         total_warnings=total_warnings, 
+        low_stock=LOW_STOCK,
         deleteForm=deleteForm, 
         total_pages=total_pages, 
         current_page=page, 
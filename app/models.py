@@ -1,8 +1,9 @@
 from . import db
 from flask import current_app
 from flask_login import UserMixin
-from sqlalchemy import event
-from sqlalchemy.orm import Session
+from sqlalchemy import event, select, update, inspect, case, cast, Float
+from sqlalchemy.orm import Session, column_property
+from sqlalchemy.orm.util import identity_key
 from sqlalchemy.sql import func
 from itsdangerous import URLSafeTimedSerializer as Serializer
 import random
@@ -122,7 +123,7 @@ class Product(db.Model):
   description = db.Column(db.Text, nullable=True)
   image_thumbnail = db.Column(db.String(300), nullable=True)
   images = db.Column(db.JSON, nullable=True)  # list of uploaded images
-  conditions = db.Column(db.JSON, nullable=True)  # store conditions (name, stock, price)
+  conditions_json = db.Column('conditions', db.JSON, nullable=True)  # legacy, conditions now live in product_conditions (only read to migrate old databases)
   is_featured_special = db.Column(db.Boolean, nullable=False)
   is_featured_staff = db.Column(db.Boolean, nullable=False)
   created_at = db.Column(db.DateTime(timezone=True), default=func.now())
@@ -138,28 +139,236 @@ class Product(db.Model):
   cart_entries = db.relationship('Cart', back_populates='product', lazy=True)
   reviews = db.relationship('Review', back_populates='product', lazy=True, cascade='all, delete-orphan')
   rating = db.Column(db.Float, default=0, nullable=True)
+
+  # review aggregates, adjusted by each review write (see apply_review_delta) instead of re-summing every review
+  rating_sum = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+  rating_count = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+  rating_1 = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+  rating_2 = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+  rating_3 = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+  rating_4 = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+  rating_5 = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+
+  RATING_COLUMNS = {1: 'rating_1', 2: 'rating_2', 3: 'rating_3', 4: 'rating_4', 5: 'rating_5'}
+
+  # one row per condition (name, price, stock), loaded together for a whole page of products
+  condition_rows = db.relationship('ProductCondition', back_populates='product', order_by='ProductCondition.position', lazy='selectin', cascade='all, delete-orphan')
+
+  # conditions as a list of {'condition', 'price', 'stock'} dicts, the first is the default
+  @property
+  def conditions(self):
+    return [row.to_dict() for row in self.condition_rows]
+
+  @conditions.setter
+  def conditions(self, conditions):
+    # existing rows are updated in place, a condition listed twice keeps its last entry
+    existing = {row.condition: row for row in self.condition_rows}
+    rows = {}
+    for condition in conditions or []:
+      row = rows.get(condition['condition']) or existing.get(condition['condition']) or ProductCondition(condition=condition['condition'])
+      row.price = condition['price']
+      row.stock = condition['stock']
+      rows[condition['condition']] = row
+    for position, row in enumerate(rows.values()):
+      row.position = position
+    self.condition_rows = list(rows.values())
+
+  # denormalised from product_conditions on every condition write (recount_condition_columns), so price and stock sorts and filters can use an index
+  price = db.Column(db.Float, nullable=True, index=True)  # the default (first) condition's price, the one product cards show
+  total_stock = db.Column(db.Integer, nullable=False, default=0, server_default='0', index=True)
+
+  @property
+  def rating_histogram(self):
+    # {stars: number of reviews}, highest first
+    return {stars: getattr(self, column) or 0 for stars, column in sorted(self.RATING_COLUMNS.items(), reverse=True)}
+
   def update_rating(self):
-    if self.reviews:
-      total_rating = sum(review.rating for review in self.reviews)
-      self.rating = round(total_rating / len(self.reviews), 2)
-    else:
-      self.rating = 0
+    # full recount from the reviews, only needed to backfill (reviews keep the aggregates up to date themselves)
+    ratings = [review.rating for review in self.reviews]
+    self.rating_sum = sum(ratings)
+    self.rating_count = len(ratings)
+    for stars, column in self.RATING_COLUMNS.items():
+      setattr(self, column, ratings.count(stars))
+    self.rating = round(self.rating_sum / self.rating_count, 2) if ratings else 0
+
+class ProductCondition(db.Model):
+  __tablename__ = 'product_conditions'
+  id = db.Column(db.Integer, primary_key=True, autoincrement=True)
+  product_id = db.Column(db.Integer, db.ForeignKey('products.id'), nullable=False)
+  position = db.Column(db.Integer, nullable=False, default=0)  # listing order, 0 is the default condition
+  condition = db.Column(db.String(50), nullable=False)
+  price = db.Column(db.Float, nullable=False)
+  stock = db.Column(db.Integer, nullable=False, default=0)
+
+  product = db.relationship('Product', back_populates='condition_rows')
+
+  __table_args__ = (
+    db.UniqueConstraint('product_id', 'condition', name='uq_product_conditions_product_condition'),
+    db.Index('ix_product_conditions_condition_stock', 'condition', 'stock'),
+  )
+
+  def to_dict(self):
+    return {'condition': self.condition, 'price': self.price, 'stock': self.stock}
+
+  @staticmethod
+  def take_stock(product_id, condition, quantity):
+    # atomic UPDATE ... SET stock = stock - quantity, so concurrent orders can't overwrite each other's decrement
+    # returns False (and changes nothing) if there isn't enough stock left
+    result = db.session.execute(
+      update(ProductCondition)
+      .where(ProductCondition.product_id == product_id, ProductCondition.condition == condition, ProductCondition.stock >= quantity)
+      .values(stock=ProductCondition.stock - quantity)
+      .execution_options(synchronize_session=False)
+    )
+    if result.rowcount != 1:
+      return False
+
+    # the product's total (see recount_condition_columns), decremented the same way, bulk updates don't run the row events
+    db.session.execute(
+      update(Product)
+      .where(Product.id == product_id)
+      .values(total_stock=Product.total_stock - quantity)
+      .execution_options(synchronize_session=False)
+    )
+    return True
+
+# keep the product's denormalised price and total stock in step with its conditions, whichever side the write came from
+def recount_condition_columns(connection, product_ids):
+  def of_product(expression):
+    return select(expression).where(ProductCondition.product_id == Product.id)
+  connection.execute(update(Product).where(Product.id.in_(product_ids)).values(
+    price=of_product(ProductCondition.price).order_by(ProductCondition.position).limit(1).scalar_subquery(),
+    total_stock=of_product(func.coalesce(func.sum(ProductCondition.stock), 0)).scalar_subquery()
+  ))
+
+def expire_product_stock(row, *product_ids):
+  # products already in the session reload their price and stock after the flush
+  session = Session.object_session(row)
+  if session is not None:
+    session.info.setdefault('stocked_products', set()).update(product_ids)
+
+@event.listens_for(ProductCondition, 'after_insert')
+@event.listens_for(ProductCondition, 'after_update')
+@event.listens_for(ProductCondition, 'after_delete')
+def recount_product_conditions(mapper, connection, row):
+  product_ids = {row.product_id, committed_value(row, 'product_id')}
+  recount_condition_columns(connection, product_ids)
+  expire_product_stock(row, *product_ids)
+
+@event.listens_for(Session, 'after_flush_postexec')
+def expire_stocked_products(session, flush_context):
+  for product_id in session.info.pop('stocked_products', ()):
+    product = session.identity_map.get(identity_key(Product, product_id))
+    if product is not None and inspect(product).persistent:
+      session.expire(product, ['price', 'total_stock'])
 
 class Review(db.Model):
   __tablename__ = 'reviews'
   id = db.Column(db.Integer, primary_key=True, autoincrement=True)
   show_username = db.Column(db.Boolean, default=False)
-  rating = db.Column(db.Integer, nullable=False)
+  # active_history loads the old value on assignment even when it was expired, the aggregate events need it
+  rating = column_property(db.Column(db.Integer, nullable=False), active_history=True)
   description = db.Column(db.String(1000), nullable=True)
   created_at = db.Column(db.DateTime(timezone=True), default=func.now())
   updated_at = db.Column(db.DateTime(timezone=True), default=func.now(), onupdate=func.now())
 
-  product_id = db.Column(db.Integer, db.ForeignKey('products.id'), nullable=False)
+  product_id = column_property(db.Column(db.Integer, db.ForeignKey('products.id'), nullable=False), active_history=True)
   product = db.relationship('Product', back_populates='reviews', lazy=True)
 
   user_id = db.Column(db.Integer, db.ForeignKey('users.id'), nullable=True)
   user = db.relationship('User', back_populates='reviews', lazy=True)
 
+  __table_args__ = (
+    # a product's reviews, filtered by stars and paged by id, straight from the index
+    db.Index('ix_reviews_product_rating_id', 'product_id', 'rating', 'id'),
+  )
+
+# keep the product's review aggregates in step, one relative UPDATE per review write
+def apply_review_delta(connection, product_id, rating, sign):
+  rating = int(rating)
+  new_count = Product.rating_count + sign
+  values = {
+    'rating_sum': Product.rating_sum + sign * rating,
+    'rating_count': new_count,
+    # SET expressions see the row before the update, so the average is worked out from the new totals
+    'rating': case((new_count > 0, func.round(cast(Product.rating_sum + sign * rating, Float) / new_count, 2)), else_=0)
+  }
+  column = Product.RATING_COLUMNS.get(rating)
+  if column:
+    values[column] = getattr(Product, column) + sign
+  connection.execute(update(Product).where(Product.id == product_id).values(**values))
+
+def committed_value(review, name):
+  history = inspect(review).attrs[name].history
+  return history.deleted[0] if history.deleted else getattr(review, name)
+
+def expire_product_rating(review, *product_ids):
+  # products already in the session reload their aggregates after the flush
+  session = Session.object_session(review)
+  if session is not None:
+    session.info.setdefault('rated_products', set()).update(product_ids)
+
+@event.listens_for(Review, 'after_insert')
+def add_review_rating(mapper, connection, review):
+  apply_review_delta(connection, review.product_id, review.rating, 1)
+  expire_product_rating(review, review.product_id)
+
+@event.listens_for(Review, 'after_update')
+def change_review_rating(mapper, connection, review):
+  old_product_id, old_rating = committed_value(review, 'product_id'), committed_value(review, 'rating')
+  if (old_product_id, int(old_rating)) != (review.product_id, int(review.rating)):
+    apply_review_delta(connection, old_product_id, old_rating, -1)
+    apply_review_delta(connection, review.product_id, review.rating, 1)
+    expire_product_rating(review, old_product_id, review.product_id)
+
+@event.listens_for(Review, 'after_delete')
+def remove_review_rating(mapper, connection, review):
+  product_id = committed_value(review, 'product_id')
+  apply_review_delta(connection, product_id, committed_value(review, 'rating'), -1)
+  expire_product_rating(review, product_id)
+
+def expire_ratings(session, product_ids):
+  for product_id in product_ids:
+    product = session.identity_map.get(identity_key(Product, product_id))
+    if product is not None:
+      session.expire(product, ['rating', 'rating_sum', 'rating_count', *Product.RATING_COLUMNS.values()])
+
+@event.listens_for(Session, 'after_flush_postexec')
+def expire_rated_products(session, flush_context):
+  expire_ratings(session, session.info.pop('rated_products', ()))
+
+def recount_ratings(session, product_ids):
+  # full recount in SQL, for writes that bypass the review events
+  def total(expression, *criteria):
+    return select(expression).where(Review.product_id == Product.id, *criteria).scalar_subquery()
+  rating_count = total(func.count(Review.id))
+  rating_sum = total(func.coalesce(func.sum(Review.rating), 0))
+  values = {
+    'rating_sum': rating_sum,
+    'rating_count': rating_count,
+    'rating': case((rating_count > 0, func.round(cast(rating_sum, Float) / rating_count, 2)), else_=0)
+  }
+  for stars, column in Product.RATING_COLUMNS.items():
+    values[column] = total(func.count(Review.id), Review.rating == stars)
+  session.execute(update(Product).where(Product.id.in_(product_ids)).values(**values))
+  expire_ratings(session, product_ids)
+
+@event.listens_for(Session, 'do_orm_execute')
+def recount_after_bulk_review_delete(orm_execute_state):
+  # bulk deletes (e.g. Review.query.filter_by(user_id=...).delete() when an account goes) don't run the review events,
+  # so the products they touch are recounted once the rows are gone
+  if not orm_execute_state.is_delete or orm_execute_state.bind_mapper is None or orm_execute_state.bind_mapper.class_ is not Review:
+    return None
+  session = orm_execute_state.session
+  affected = select(Review.product_id).distinct()
+  if orm_execute_state.statement.whereclause is not None:
+    affected = affected.where(orm_execute_state.statement.whereclause)
+  product_ids = session.scalars(affected).all()
+  result = orm_execute_state.invoke_statement()
+  if product_ids:
+    recount_ratings(session, product_ids)
+  return result
+
 class Category(db.Model): 
   __tablename__ = 'categories'
   id = db.Column(db.Integer, primary_key=True, autoincrement=True)
@@ -355,4 +564,23 @@ class ChatHistory(db.Model):
     
   # Relationships
   admin = db.relationship('User', foreign_keys=[admin_id], backref='admin_chats')
-  user = db.relationship('User', foreign_keys=[user_id], backref='user_chats')
\ No newline at end of file
+  user = db.relationship('User', foreign_keys=[user_id], backref='user_chats')
+
+# Background jobs (see jobQueue.py)
+class Job(db.Model):
+  __tablename__ = 'jobs'
+  id = db.Column(db.Integer, primary_key=True, autoincrement=True)
+  name = db.Column(db.String(100), nullable=False)  # registered handler
+  payload = db.Column(db.JSON, nullable=False, default=dict)  # keyword arguments for the handler
+  status = db.Column(db.String(20), nullable=False, default='queued')  # queued, running, done, failed
+  attempts = db.Column(db.Integer, nullable=False, default=0)
+  max_attempts = db.Column(db.Integer, nullable=False, default=5)
+  run_after = db.Column(db.DateTime, nullable=False, default=datetime.now)  # not picked up before this (retry backoff)
+  locked_at = db.Column(db.DateTime, nullable=True)  # when a worker claimed it
+  last_error = db.Column(db.Text, nullable=True)
+  created_at = db.Column(db.DateTime, nullable=False, default=datetime.now)
+  finished_at = db.Column(db.DateTime, nullable=True)
+
+  __table_args__ = (
+    db.Index('ix_jobs_status_run_after', 'status', 'run_after'),
+  )
\ No newline at end of file
@@ -1,11 +1,11 @@
 from flask import Blueprint, render_template, redirect, url_for, request, flash, current_app, abort, jsonify
 from flask_login import login_required, current_user
-from flask_mail import Message
 from .models import MailingList, MailingPost
 from .forms import NewsletterForm
 from .roleDecorator import role_required
-from . import db, mail
+from . import db
 from .views import generate_unsubscribe_token
+from .jobQueue import enqueue
 from math import ceil
 from dotenv import load_dotenv
 import os
@@ -16,8 +16,6 @@ newsletter = Blueprint('newsletter', __name__)
 # Newsletter page
 
 def send_newsletter(form):
-  current_app.config['UPDATE_MAIL_CONFIG']('newsletter')
-
   mailing_list = MailingList.query.all()
   mailing_count = MailingList.query.count()
     
@@ -44,29 +42,19 @@ def send_newsletter(form):
         unsubscribe_link=unsubscribe_link
       )
 
-      # Create message for each subscriber
-      msg = Message(
-        subject=form.title.data, 
-        sender=('Rewwwind Mail', current_app.config['MAIL_USERNAME']),
-        recipients=[subscriber.email],
-        html=html_body
-      )
-
-      # with open(image_path, 'rb') as img:
-      #   msg.attach(
-      #     'abstractheader2.jpg',
-      #     'image/jpeg',
-      #     img.read(),
-      #     'inline',
-      #     headers={'Content-ID': '<header_image>'} 
-      #   )
-
-      mail.send(msg)
+      # one email job per subscriber, sent in the background and retried on their own (see jobQueue.py)
+      enqueue('send_email', {
+        'account': 'newsletter',
+        'sender_name': 'Rewwwind Mail',
+        'subject': form.title.data,
+        'recipients': [subscriber.email],
+        'html': html_body
+      })
 
-    # Commit token changes to database
+    # Commit token changes and the email jobs to database
     db.session.commit()
 
-    flash('Newsletter sent successfully!', 'success')
+    flash(f'Newsletter is being sent to {mailing_count} subscribers.', 'success')
     return True
   except Exception as e:
     current_app.logger.error(f"Newsletter sending failed: {str(e)}")
@@ -0,0 +1,103 @@
+from flask import current_app, request, session, make_response, has_app_context
+from flask_login import current_user
+from flask_wtf.csrf import generate_csrf
+from sqlalchemy import event
+from sqlalchemy.orm import Session
+from functools import wraps
+import hashlib
+import os
+import time
+
+from .models import Product, ProductCondition, Review, Category, SubCategory
+from .queryCache import get_cache
+
+# Rendered page cache for the anonymous product listings
+# Pages are cached per path and normalised query string, and dropped whenever the catalog version changes.
+# The version is a number in CATALOG_VERSION_FILE (instance/catalog_version), bumped after any commit that writes products, conditions/stock,
+# reviews or the taxonomy, so every worker process sees it with a stat() and no database query.
+# Responses carry an ETag, browsers revalidating an unchanged page get a 304.
+CSRF_PLACEHOLDER = '__csrf_token__'
+CATALOG_MODELS = (Product, ProductCondition, Review, Category, SubCategory)
+
+_version = (None, 0)  # (file mtime, version)
+
+def version_file():
+    return current_app.config['CATALOG_VERSION_FILE']
+
+def catalog_version():
+    global _version
+    try:
+        mtime = os.stat(version_file()).st_mtime_ns
+    except FileNotFoundError:
+        return 0
+    if _version[0] != mtime:
+        with open(version_file()) as file:
+            _version = (mtime, int(file.read().strip() or 0))
+    return _version[1]
+
+def bump_catalog_version():
+    # written to a temporary file and renamed, readers never see a partial number
+    os.makedirs(os.path.dirname(version_file()), exist_ok=True)
+    temporary = f"{version_file()}.{os.getpid()}.tmp"
+    with open(temporary, 'w') as file:
+        file.write(str(time.time_ns()))
+    os.replace(temporary, version_file())
+
+def normalised_query():
+    # parameter order and empty parameters don't make a different page
+    return tuple(sorted((name, value) for name, value in request.args.items(multi=True) if value != ''))
+
+def cacheable():
+    # signed-in users see wishlists and roles, flashed messages and visual search distances live in the session
+    return not current_user.is_authenticated and '_flashes' not in session and not request.args.get('similar')
+
+def cached_page(view):
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        if not cacheable():
+            return view(*args, **kwargs)
+
+        page_cache = get_cache('rendered_pages', current_app.config['PAGE_CACHE_SIZE'], current_app.config['PAGE_CACHE_TTL'])
+        page_cache.sync_generation(catalog_version())
+        key = (request.path, normalised_query())
+        entry = page_cache.get(key)
+        if entry is None:
+            response = make_response(view(*args, **kwargs))
+            if response.status_code != 200 or response.mimetype != 'text/html':
+                return response
+            # the CSRF token belongs to this visitor's session, cached pages get each visitor's own
+            body = response.get_data(as_text=True).replace(generate_csrf(), CSRF_PLACEHOLDER)
+            entry = (hashlib.sha1(body.encode()).hexdigest(), body)
+            page_cache.set(key, entry)
+
+        digest, body = entry
+        response = make_response(body.replace(CSRF_PLACEHOLDER, generate_csrf()))
+        # the token differs per session and expires, so it is part of the validator
+        token_window = int(time.time() // ((current_app.config.get('WTF_CSRF_TIME_LIMIT') or 3600) / 2))
+        validator = f"{digest}:{session.get('csrf_token')}:{token_window}"
+        response.set_etag(hashlib.sha1(validator.encode()).hexdigest(), weak=True)
+        response.headers['Cache-Control'] = 'private, no-cache'
+        return response.make_conditional(request)
+    return wrapper
+
+# bump the catalog version once catalog writes are committed
+@event.listens_for(Session, 'before_flush')
+def record_catalog_change(db_session, flush_context, instances):
+    if any(isinstance(target, CATALOG_MODELS) for target in (*db_session.new, *db_session.dirty, *db_session.deleted)):
+        db_session.info['catalog_changed'] = True
+
+@event.listens_for(Session, 'do_orm_execute')
+def record_catalog_statement(orm_execute_state):
+    # bulk UPDATE/DELETE statements, e.g. ProductCondition.take_stock
+    if (orm_execute_state.is_update or orm_execute_state.is_delete) and orm_execute_state.bind_mapper is not None \
+            and orm_execute_state.bind_mapper.class_ in CATALOG_MODELS:
+        orm_execute_state.session.info['catalog_changed'] = True
+
+@event.listens_for(Session, 'after_commit')
+def bump_on_commit(db_session):
+    if db_session.info.pop('catalog_changed', False) and has_app_context():
+        bump_catalog_version()
+
+@event.listens_for(Session, 'after_soft_rollback')
+def discard_catalog_change(db_session, previous_transaction):
+    db_session.info.pop('catalog_changed', None)
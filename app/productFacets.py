@@ -0,0 +1,69 @@
+from sqlalchemy import select, union_all, literal, case, cast, func, Integer
+
+from . import db
+from .models import Product, ProductSubCategory
+from .queryCache import get_cache
+
+# Facet counts for the storefront filter sidebar
+# Number of matching products per category, genre, star rating and price band for the current listing query.
+# All four facets come from one statement: the matching product ids are selected once (CTE)
+# and each facet is a GROUP BY over them, joined with UNION ALL, so it is a single round trip however many facets there are.
+
+# (value, label, lowest price, highest price), by the default condition's price shown on the cards, upper bound exclusive
+PRICE_BANDS = [
+    ('under-25', 'Under $25', None, 25),
+    ('25-50', '$25 to $50', 25, 50),
+    ('50-100', '$50 to $100', 50, 100),
+    ('over-100', 'Over $100', 100, None)
+]
+
+def price_band_filter(value):
+    # filter clause for a price band, None for unknown values
+    for band, _, low, high in PRICE_BANDS:
+        if band == value:
+            clauses = []
+            if low is not None:
+                clauses.append(Product.price >= low)
+            if high is not None:
+                clauses.append(Product.price < high)
+            return db.and_(*clauses)
+    return None
+
+def price_band_expression():
+    return case(
+        *[(price_band_filter(band), band) for band, _, _, _ in PRICE_BANDS],
+        else_=None
+    )
+
+def facet_counts(products_query):
+    """
+    Returns {'category': {category id: count}, 'subcategory': {subcategory id: count},
+             'rating': {stars: count}, 'price': {band: count}} for the products matched by products_query.
+    """
+    matched = products_query.with_entities(Product.id.label('id')).order_by(None).cte('matched')
+    in_matched = Product.id == matched.c.id
+
+    def grouped(facet, key):
+        return select(literal(facet).label('facet'), key.label('value'), func.count().label('total')).select_from(matched).group_by(key)
+
+    statement = union_all(
+        grouped('category', Product.category_id).join(Product, in_matched),
+        grouped('subcategory', ProductSubCategory.subcategory_id).join(ProductSubCategory, ProductSubCategory.product_id == matched.c.id),
+        grouped('rating', cast(Product.rating, Integer)).join(Product, in_matched),
+        grouped('price', price_band_expression()).join(Product, in_matched)
+    )
+
+    counts = {'category': {}, 'subcategory': {}, 'rating': {}, 'price': {}}
+    for facet, value, total in db.session.execute(statement):
+        if value is not None:
+            counts[facet][value] = total
+    return counts
+
+def cached_facet_counts(products_query, signature, ttl):
+    # keyed by the filter signature, products are shared by every page of the same listing
+    facet_cache = get_cache('catalog_facets', ttl=ttl)
+    counts = facet_cache.get(signature)
+    if counts is None:
+        counts = facet_counts(products_query)
+        facet_cache.set(signature, counts)
+    return counts
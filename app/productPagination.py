@@ -1,101 +1,218 @@
-from flask import Blueprint, render_template, redirect, url_for, request, flash, abort, jsonify, current_app
+from flask import Blueprint, render_template, redirect, url_for, request, flash, abort, jsonify, current_app, session
 from flask_login import login_required, current_user
-from sqlalchemy import cast, Float, Integer, func
+from sqlalchemy import cast, case, Integer, func
 from sqlalchemy.orm.attributes import flag_modified
+from werkzeug.exceptions import RequestEntityTooLarge
 from .roleDecorator import role_required
 from .models import Product, Review, Category, SubCategory
 from .forms import AddReviewForm, AddToCartForm, DeleteReviewForm, MailingListForm
 from . import db
+from . import embeddings
+from .clipModel import embed_images, decode_image
+from .embeddingWorker import embed_query_image, embed_query_text
+from .queryCache import get_cache, cache_stats
+from .productSearch import search_products
+from .autocomplete import suggestions
+from .keysetPagination import keyset_page
+from .productFacets import PRICE_BANDS, price_band_filter, cached_facet_counts
+from .taxonomy import get_taxonomy
+from .pageCache import cached_page
+from .loadProfiles import load_profile
 from math import ceil
 
-from PIL import Image
-import numpy as np
-from transformers import CLIPProcessor, CLIPModel
-import torch
-import os
-from scipy.spatial.distance import cdist
+import hashlib
 
 productPagination = Blueprint('productPagination', __name__)
 
-# Initialize the CLIP model and processor
-model = CLIPModel.from_pretrained("openai/clip-vit-base-patch32")
-processor = CLIPProcessor.from_pretrained("openai/clip-vit-base-patch32")
-
-# Function to extract image embedding using CLIP
-def extract_image_embedding(image_path):
-    image = Image.open(image_path).convert('RGB')
-    inputs = processor(images=image, return_tensors="pt")
-    with torch.no_grad():
-        embeddings = model.get_image_features(**inputs)
-    return embeddings.squeeze().numpy()
-
 # Precompute embeddings for all product images
+# Embeddings are cached on disk by image hash, so only new or changed images go through the model.
 def precompute_product_embeddings():
-    product_embeddings = {}
-    for product in Product.query.all():
-        if product.images:
-            for image_path in product.images:
-                full_image_path = os.path.join(current_app.static_folder, 'media', 'uploads', image_path)
-                if os.path.exists(full_image_path):
-                    embedding = extract_image_embedding(full_image_path)
-                    product_embeddings[image_path] = embedding
-                    # print(embedding)
-    return product_embeddings
-
-# Function to find the closest matching product image
-def find_matching_product(uploaded_image_path):
-    # Extract embedding for the uploaded image
-    query_embedding = extract_image_embedding(uploaded_image_path)
-    product_embeddings = current_app.config['PRODUCT_EMBEDDINGS']
-    
-    # Compute distances between the query embedding and all precomputed embeddings
-    image_paths = list(product_embeddings.keys())
-    embeddings_array = np.array(list(product_embeddings.values()))
-    distances = cdist([query_embedding], embeddings_array, metric='cosine')[0]
-    
-    # Find the closest match
-    closest_index = np.argmin(distances)
-    closest_image_path = image_paths[closest_index]
-    closest_distance = distances[closest_index]
-    
-    return closest_image_path, closest_distance
+    store = embeddings.get_store()
+    product_images = {product.id: embeddings.product_image_files(product) for product in Product.query.all()}
+    store.sync(product_images, embed_images)
+    return embeddings.refresh_index()
+
+# Function to find the closest matching products
+# Returns up to k (product id, cosine distance) pairs, closest first, raises ValueError for unusable images.
+# Queries are cached by the sha256 of the uploaded bytes: the embedding for as long as the cache keeps it,
+# the results until the catalog embeddings change. A repeated upload is never decoded or run through CLIP again.
+def find_matching_product(image_bytes, k=5):
+    image_hash = hashlib.sha256(image_bytes).hexdigest()
+    product_index = embeddings.get_index()
+    results_cache = get_cache('visual_search_results')
+    results_cache.sync_generation(current_app.config['PRODUCT_EMBEDDINGS_GENERATION'])
+    matches = results_cache.get((image_hash, k))
+    if matches is not None:
+        return matches
+
+    # Extract embedding for the uploaded image, decoded in memory
+    embedding_cache = get_cache('visual_search_embeddings')
+    query_embedding = embedding_cache.get(image_hash)
+    if query_embedding is None:
+        query_image = decode_image(image_bytes)
+        query_embedding = embed_query_image(query_image)
+        embedding_cache.set(image_hash, query_embedding)
+
+    matches = closest_products(product_index, query_embedding, k)
+    results_cache.set((image_hash, k), matches)
+    return matches
+
+def closest_products(product_index, query_embedding, k):
+    # products have several images (and identical images are shared by products),
+    # over-fetch and keep each product's closest image
+    matches = {}
+    for product_ids, distance in product_index.search(query_embedding, k * 4):
+        for product_id in product_ids:
+            if product_id not in matches:
+                matches[product_id] = distance
+        if len(matches) >= k:
+            break
+    return list(matches.items())[:k]
+
+# Text-to-image search, e.g. "moody jazz record with blue cover"
+# The query is embedded once with CLIP's text encoder and ranked against the catalog image embeddings,
+# results are cached per normalised query until the catalog embeddings change.
+def semantic_search(query, k):
+    normalised_query = ' '.join(query.lower().split())
+    product_index = embeddings.get_index()
+    results_cache = get_cache('semantic_search_results')
+    results_cache.sync_generation(current_app.config['PRODUCT_EMBEDDINGS_GENERATION'])
+    matches = results_cache.get((normalised_query, k))
+    if matches is not None:
+        return matches
+
+    embedding_cache = get_cache('semantic_search_embeddings')
+    query_embedding = embedding_cache.get(normalised_query)
+    if query_embedding is None:
+        query_embedding = embed_query_text(normalised_query)
+        embedding_cache.set(normalised_query, query_embedding)
+
+    matches = closest_products(product_index, query_embedding, k)
+    results_cache.set((normalised_query, k), matches)
+    return matches
+
+def upload_error(message):
+    if request.accept_mimetypes.best == 'application/json':
+        return jsonify({'error': message}), 400
+    flash(message, "error")
+    return redirect(url_for('productPagination.product_pagination'))
+
+# room for the multipart boundary and part headers on top of the image itself
+MULTIPART_OVERHEAD = 64 * 1024
 
 @productPagination.route('/upload_image', methods=['GET', 'POST'])
 def upload_image():
     SIMILARITY_THRESHOLD = 0.4
 
     if request.method == 'POST':
-        uploaded_image = request.files['file']
+        # Bodies too large for an allowed image are refused before they are parsed,
+        # and the upload is kept in memory (see BoundedUploadRequest), nothing is written to disk
+        max_bytes = current_app.config['VISUAL_SEARCH_MAX_UPLOAD_BYTES']
+        request.max_content_length = max_bytes + MULTIPART_OVERHEAD
+        try:
+            uploaded_image = request.files['file']
+        except RequestEntityTooLarge:
+            return upload_error(f"Image file is too large, the limit is {max_bytes / (1024 * 1024):g} MB.")
         if uploaded_image:
-            # Save the uploaded image
-            uploaded_image_path = os.path.join(current_app.static_folder, 'media', 'challenge', "uploaded_image.jpg")
-            uploaded_image.save(uploaded_image_path)
-            
-            # Access embeddings
-            closest_image_path, closest_distance = find_matching_product(uploaded_image_path)
-
-            print(f"Closest Image Path: {closest_image_path}")
-            print(f"Closest Distance: {closest_distance}")
-
-            # Check if the closest match meets the similarity threshold
-            if closest_distance < SIMILARITY_THRESHOLD:
-                # Query the product that contains the closest image path
-                product = Product.query.filter(
-                    Product.images.like(f"%{closest_image_path}%")
-                ).first()
-
-                if product:
-                    print(f"Found matching product: {product.name} (Distance: {closest_distance:.4f})", "success")
-                    return redirect(url_for('productPagination.product_pagination', q=product.name))
-                else:
-                    print("No matching products were found.")
-                    return redirect(url_for('productPagination.product_pagination', q='Nothing found.'))
+            image_bytes = uploaded_image.stream.read(max_bytes + 1)
+            try:
+                results = find_matching_product(image_bytes, current_app.config['VISUAL_SEARCH_TOP_K'])
+            except ValueError as e:
+                return upload_error(str(e))
+
+            # Access embeddings, only keep matches within the similarity threshold
+            matches = [(product_id, distance) for product_id, distance in results if distance < SIMILARITY_THRESHOLD]
+
+            if request.accept_mimetypes.best == 'application/json':
+                return jsonify({'results': [{'product_id': product_id, 'distance': round(distance, 4)} for product_id, distance in matches]})
+
+            if matches:
+                # ranked results are listed on the products page, distances are shown as a match percentage
+                session['visual_search'] = {str(product_id): round(distance, 4) for product_id, distance in matches}
+                return redirect(url_for('productPagination.product_pagination', similar=','.join(str(product_id) for product_id, _ in matches)))
             else:
                 print("No matches meet the similarity threshold.")
                 return redirect(url_for('productPagination.product_pagination', q='Nothing found.'))
 
     return render_template("views/upload_image.html")
 
+# Infinite scroll: the listing as JSON, with the same filters as the products page
+# Continue with ?cursor=<next_cursor> until next_cursor is null.
+@productPagination.route('/feed')
+def product_feed():
+    products, total_products, *_, facets = pagination()
+    return jsonify({
+        'products': [{
+            'id': product.id,
+            'name': product.name,
+            'creator': product.creator,
+            'price': product.price,
+            'rating': product.rating,
+            'image_thumbnail': product.image_thumbnail,
+            'url': url_for('productPagination.product_detail', product_id=product.id)
+        } for product in products.items],
+        'total': total_products,
+        'facets': facets,
+        'next_cursor': products.next_cursor
+    })
+
+# A product's reviews as JSON, so more reviews can be loaded without re-rendering the product page
+# ?rating=1..5 keeps one star rating, ?sort=highest|lowest orders by rating, continue with ?cursor=<next_cursor>.
+@productPagination.route('/product/<int:product_id>/reviews')
+def product_reviews(product_id):
+    product = Product.query.get_or_404(product_id)
+    per_page = max(1, min(request.args.get('limit', 5, type=int), 50))
+    rating = request.args.get('rating', None, type=int)
+    sort = request.args.get('sort', '', type=str)
+
+    # product_id, rating and id are all in ix_reviews_product_rating_id
+    reviews_query = Review.query.filter(Review.product_id == product_id).options(*load_profile('review_list'))
+    total = product.rating_count
+    if rating in Product.RATING_COLUMNS:
+        reviews_query = reviews_query.filter(Review.rating == rating)
+        total = product.rating_histogram[rating]
+    sort_keys = [('rating', Review.rating, sort == 'highest')] if sort in ('highest', 'lowest') else []
+    reviews = keyset_page(reviews_query, sort_keys, per_page, cursor=request.args.get('cursor', None, type=str), id_column=Review.id)
+
+    return jsonify({
+        'reviews': [{
+            'id': review.id,
+            'rating': review.rating,
+            'description': review.description,
+            'username': review.user.username if review.show_username and review.user else 'Anonymous',
+            'image': url_for('static', filename='profile_pics/' + review.user.image) if review.user else None,
+            'created_at': review.created_at.isoformat() if review.created_at else None,
+            'own': current_user.is_authenticated and review.user_id == current_user.id
+        } for review in reviews.items],
+        'total': total,
+        'histogram': product.rating_histogram,
+        'next_cursor': reviews.next_cursor
+    })
+
+# Search-as-you-type suggestions for the search bar, served from the in-memory prefix index
+@productPagination.route('/autocomplete')
+def autocomplete():
+    query = request.args.get('q', '', type=str)
+    limit = max(1, min(request.args.get('limit', 8, type=int), 20))
+
+    results = []
+    for kind, label, product_id in suggestions(query, limit):
+        if kind == 'product':
+            url = url_for('productPagination.product_detail', product_id=product_id)
+        elif kind == 'creator':
+            url = url_for('productPagination.product_pagination', q=label)
+        else:
+            url = url_for('productPagination.product_pagination', genre=label.lower())
+        results.append({'label': label, 'type': kind, 'url': url})
+    return jsonify({'query': query, 'suggestions': results})
+
+# Hit/miss counters of this worker's search caches
+@productPagination.route('/search_cache_stats')
+@login_required
+@role_required(2, 3)
+def search_cache_stats():
+    return jsonify(cache_stats())
+
 def pagination(featured=None):
     # Base query
     products_query = Product.query
@@ -107,8 +224,27 @@ def pagination(featured=None):
 
     # Search logic
     search_query = request.args.get('q', '', type=str)
-    if search_query:
-        products_query = products_query.filter(Product.name.ilike(f"%{search_query}%"))
+    search_mode = request.args.get('mode', '', type=str)
+    search_order = []  # relevance, applied after any sort the user picked
+    if search_query and search_mode == 'semantic':
+        # ranked by how well the product images match the description
+        semantic_ids = [product_id for product_id, _ in semantic_search(search_query, current_app.config['SEMANTIC_SEARCH_TOP_K'])]
+        products_query = products_query.filter(Product.id.in_(semantic_ids))
+        if semantic_ids:
+            search_order = [case({product_id: rank for rank, product_id in enumerate(semantic_ids)}, value=Product.id)]
+    elif search_query:
+        products_query, search_order = search_products(products_query, search_query)
+
+    # (name, expression, descending), in order of precedence, Product.id breaks ties
+    sort_keys = []
+
+    # Visual search results, listed in order of similarity
+    similar_filter = request.args.get('similar', '', type=str)
+    if similar_filter:
+        similar_ids = [int(entry) for entry in similar_filter.split(',') if entry.isdigit()]
+        products_query = products_query.filter(Product.id.in_(similar_ids))
+        if similar_ids:
+            sort_keys.append(('similar', case({product_id: rank for rank, product_id in enumerate(similar_ids)}, value=Product.id), False))
 
     # Filter logic
     category_filter = request.args.get('type', '', type=str)
@@ -121,6 +257,7 @@ def pagination(featured=None):
     if not match_req:
         match_req = 'or'
     price_filter = request.args.get('price', '', type=str)
+    band_filter = request.args.get('band', '', type=str)
     rating_filter = request.args.get('rating', '', type=str)
 
     if category_filter:
@@ -137,41 +274,49 @@ def pagination(featured=None):
                 func.count(Product.id) == len(subcategory_filter)
             )
     if price_filter:
+        # indexed column kept in step with conditions, the default condition's price shown on the cards
         if 'highest' in price_filter:
-            products_query = products_query.order_by(cast(Product.conditions[0]['price'], Float).desc())
+            sort_keys.append(('price', Product.price, True))
         else:
-            products_query = products_query.order_by(cast(Product.conditions[0]['price'], Float).asc())
+            sort_keys.append(('price', Product.price, False))
+    if band_filter:
+        band_clause = price_band_filter(band_filter)
+        if band_clause is not None:
+            products_query = products_query.filter(band_clause)
+        else:
+            band_filter = ''
     if rating_filter:
         try:
             rating_filter = int(rating_filter)
             products_query = products_query.filter(cast(Product.rating, Integer) == rating_filter)
             rating_filter = str(rating_filter)
         except ValueError:
-            if 'highest' in rating_filter:
-                products_query = products_query.order_by(Product.rating.desc())
-            else:
-                products_query = products_query.order_by(Product.rating.asc())
-        
+            sort_keys.append(('rating', Product.rating, 'highest' in rating_filter))
+    sort_keys += [('relevance', expression, False) for expression in search_order]
 
     # Pagination logic
+    # "Next" links and the feed carry a cursor, so deep pages don't pay for an OFFSET scan,
+    # and the total is cached per filter combination for a short while instead of counted on every page.
     page = request.args.get('page', 1, type=int)
+    cursor = request.args.get('cursor', None, type=str)
     per_page = 16
 
-    total_products = products_query.count()
-    products = products_query.order_by(Product.id).paginate(page=page, per_page=per_page)
+    total_products = cached_count(products_query, featured)
+    # number of matching products per sidebar choice, only the full listing has the sidebar
+    facets = cached_facet_counts(products_query, filter_signature(featured), current_app.config['CATALOG_COUNT_TTL']) if featured is None else None
+    products = keyset_page(products_query.options(*load_profile('product_list')), sort_keys, per_page, cursor=cursor, page=page)
 
 
     total_pages = ceil(total_products / per_page)
 
-    categories = Category.query.all()[:8]
-    subcategories = SubCategory.query.all()
-    if category_filter:
-        subcategories = SubCategory.query.join(Category).filter(Category.category_name == category_filter.title())
+    taxonomy = get_taxonomy()
+    categories = taxonomy.categories[:8]
+    subcategories = taxonomy.subcategories_of(category_filter)
 
     # filter choices
-    category_choices = [(category.category_name.lower(), category.category_name) for category in categories]
+    category_choices = [(name.lower(), facet_label(name, facets, 'category', category_id)) for category_id, name in categories]
 
-    subcategory_choices = [(subcategory.subcategory_name.lower(), subcategory.subcategory_name) for subcategory in subcategories]
+    subcategory_choices = [(name.lower(), facet_label(name, facets, 'subcategory', subcategory_id)) for subcategory_id, name, _ in subcategories]
         
 
     price_choices = [
@@ -182,21 +327,46 @@ def pagination(featured=None):
     rating_choices = [
         ('highest', 'Highest first'),
         ('lowest', 'Lowest first'),
-        ('1', '1 star'),
-        ('2', '2 star'),
-        ('3', '3 star'),
-        ('4', '4 star'),
-        ('5', '5 star')
+        ('1', facet_label('1 star', facets, 'rating', 1)),
+        ('2', facet_label('2 star', facets, 'rating', 2)),
+        ('3', facet_label('3 star', facets, 'rating', 3)),
+        ('4', facet_label('4 star', facets, 'rating', 4)),
+        ('5', facet_label('5 star', facets, 'rating', 5))
     ]
 
-    return products, total_products, total_pages, page, search_query, category_filter, category_choices, subcategory_filter, match_req, subcategory_choices, price_filter, price_choices, rating_filter, rating_choices
+    band_choices = [(band, facet_label(label, facets, 'price', band)) for band, label, _, _ in PRICE_BANDS]
+
+    return products, total_products, total_pages, page, search_query, category_filter, category_choices, subcategory_filter, match_req, subcategory_choices, price_filter, price_choices, rating_filter, rating_choices, band_filter, band_choices, facets
+
+def facet_label(label, facets, facet, value):
+    if facets is None:
+        return label
+    return f"{label} ({facets[facet].get(value, 0)})"
+
+def filter_signature(featured=None):
+    # the listing's filters, page and cursor don't change which products match
+    return (featured, tuple(sorted((name, value) for name, value in request.args.items(multi=True) if name not in ('page', 'cursor'))))
+
+def cached_count(products_query, featured=None):
+    count_cache = get_cache('catalog_counts', ttl=current_app.config['CATALOG_COUNT_TTL'])
+    key = filter_signature(featured)
+    total = count_cache.get(key)
+    if total is None:
+        total = products_query.count()
+        count_cache.set(key, total)
+    return total
 
 @productPagination.route('/')
+@cached_page
 def product_pagination():    
     form = AddToCartForm()
     mailing_list_form = MailingListForm()
     
-    products, total_products, total_pages, page, search_query, category_filter, category_choices, subcategory_filter, match_req, subcategory_choices, price_filter, price_choices, rating_filter, rating_choices = pagination()
+    products, total_products, total_pages, page, search_query, category_filter, category_choices, subcategory_filter, match_req, subcategory_choices, price_filter, price_choices, rating_filter, rating_choices, band_filter, band_choices, facets = pagination()
+
+    # distances from the last visual search, if these are its results
+    match_distances = session.get('visual_search', {}) if request.args.get('similar') else {}
+
     # Render the template
     return render_template(
         "/views/products.html",
@@ -215,13 +385,16 @@ def product_pagination():
         price_choices=price_choices,
         rating_filter=rating_filter,
         rating_choices=rating_choices,
+        band_filter=band_filter,
+        band_choices=band_choices,
+        match_distances=match_distances,
         form=form,
         mailing_list_form=mailing_list_form
     )
 
 @productPagination.route('/product/<int:product_id>', methods=['GET', 'POST'])
 def product_detail(product_id):
-    product = Product.query.get_or_404(product_id)
+    product = Product.query.options(*load_profile('product_detail')).get_or_404(product_id)
     reviews_query = Review.query.filter_by(product_id=product_id)
 
     # Condition logic
@@ -243,14 +416,15 @@ def product_detail(product_id):
             reviews_query = reviews_query.order_by(Review.rating.asc())
     
     # filter choices
+    rating_histogram = product.rating_histogram
     rating_choices = [
         ('highest', 'Highest first'),
         ('lowest', 'Lowest first'),
-        ('1', '1 star'),
-        ('2', '2 star'),
-        ('3', '3 star'),
-        ('4', '4 star'),
-        ('5', '5 star')
+        ('1', f"1 star ({rating_histogram[1]})"),
+        ('2', f"2 star ({rating_histogram[2]})"),
+        ('3', f"3 star ({rating_histogram[3]})"),
+        ('4', f"4 star ({rating_histogram[4]})"),
+        ('5', f"5 star ({rating_histogram[5]})")
     ]
     
     # Pagination logic
@@ -258,7 +432,7 @@ def product_detail(product_id):
     per_page = 5
     total_reviews = reviews_query.count()
 
-    reviews = reviews_query.order_by(Review.id).paginate(page=page, per_page=per_page)
+    reviews = reviews_query.options(*load_profile('review_list')).order_by(Review.id).paginate(page=page, per_page=per_page)
     total_pages = ceil(total_reviews / per_page)
     
     if product is None:
@@ -289,7 +463,7 @@ def product_detail(product_id):
 @login_required
 @role_required(1, 2, 3)
 def add_review(product_id):
-    product = Product.query.get_or_404(product_id)
+    product = Product.query.options(*load_profile('product_detail')).get_or_404(product_id)
     reviewForm = AddReviewForm()
     cartForm = AddToCartForm()
     
@@ -297,7 +471,7 @@ def add_review(product_id):
     page = request.args.get('page', 1, type=int)
     per_page = 5
     reviews_query = Review.query.filter_by(product_id=product_id)
-    reviews = reviews_query.order_by(Review.id).paginate(page=page, per_page=per_page)
+    reviews = reviews_query.options(*load_profile('review_list')).order_by(Review.id).paginate(page=page, per_page=per_page)
 
     # Condition logic
     selected_condition_name = request.args.get('condition')
@@ -315,10 +489,6 @@ def add_review(product_id):
             user_id=current_user.id,
         )
         db.session.add(new_review)
-        
-        db.session.commit()
-
-        product.update_rating()
         db.session.commit()
         
         print(new_review.rating, new_review.show_username, new_review.description, new_review.product_id, new_review.user_id)
@@ -336,7 +506,7 @@ def add_review(product_id):
 @login_required
 @role_required(1, 2, 3)
 def update_review(product_id, review_id):
-    product = Product.query.get_or_404(product_id)
+    product = Product.query.options(*load_profile('product_detail')).get_or_404(product_id)
     reviewForm = AddReviewForm()
     cartForm = AddToCartForm()
     review = Review.query.get_or_404(review_id)
@@ -345,7 +515,7 @@ def update_review(product_id, review_id):
     page = request.args.get('page', 1, type=int)
     per_page = 5
     reviews_query = Review.query.filter_by(product_id=product_id)
-    reviews = reviews_query.order_by(Review.id).paginate(page=page, per_page=per_page)
+    reviews = reviews_query.options(*load_profile('review_list')).order_by(Review.id).paginate(page=page, per_page=per_page)
 
     # Condition logic
     selected_condition_name = request.args.get('condition')
@@ -366,8 +536,6 @@ def update_review(product_id, review_id):
             review.rating = int(reviewForm.rating.data)
             review.show_username = reviewForm.show_username.data
             review.description = reviewForm.description.data
-
-            product.update_rating()
             db.session.commit()
 
             print(review.rating, review.show_username, review.description)
@@ -387,7 +555,7 @@ def update_review(product_id, review_id):
 @login_required
 @role_required(1, 2, 3)
 def delete_review(product_id, review_id):
-    product = Product.query.get_or_404(product_id)
+    product = Product.query.options(*load_profile('product_detail')).get_or_404(product_id)
     reviewForm = AddReviewForm()
     deleteForm = DeleteReviewForm()
     cartForm = AddToCartForm()
@@ -397,7 +565,7 @@ def delete_review(product_id, review_id):
     page = request.args.get('page', 1, type=int)
     per_page = 5
     reviews_query = Review.query.filter_by(product_id=product_id)
-    reviews = reviews_query.order_by(Review.id).paginate(page=page, per_page=per_page)
+    reviews = reviews_query.options(*load_profile('review_list')).order_by(Review.id).paginate(page=page, per_page=per_page)
 
     # Condition logic
     selected_condition_name = request.args.get('condition')
@@ -415,9 +583,6 @@ def delete_review(product_id, review_id):
             db.session.delete(review)
             db.session.commit()
 
-            product.update_rating()
-            db.session.commit()
-
             flash("The review was successfully deleted.", "success")
         
         # Return an error response if validation fails
@@ -430,9 +595,10 @@ def delete_review(product_id, review_id):
     return render_template("/views/productPage.html", user=current_user, product=product, reviewform=reviewForm, cartform=cartForm, reviews=reviews, review=review, delete=True, deleteform=deleteForm, selected_condition=selected_condition)
 
 @productPagination.route('/featured/specials')
+@cached_page
 def product_specials():
     
-    products, total_products, total_pages, page, search_query, category_filter, category_choices, subcategory_filter, match_req, subcategory_choices, price_filter, price_choices, rating_filter, rating_choices = pagination('special')
+    products, total_products, total_pages, page, search_query, category_filter, category_choices, subcategory_filter, match_req, subcategory_choices, price_filter, price_choices, rating_filter, rating_choices, band_filter, band_choices, facets = pagination('special')
     
     form = AddToCartForm()
     mailing_list_form = MailingListForm()
@@ -459,8 +625,9 @@ def product_specials():
     )
 
 @productPagination.route('/featured/staff_picks')
+@cached_page
 def product_staff():
-    products, total_products, total_pages, page, search_query, category_filter, category_choices, subcategory_filter, match_req, subcategory_choices, price_filter, price_choices, rating_filter, rating_choices = pagination('staff')
+    products, total_products, total_pages, page, search_query, category_filter, category_choices, subcategory_filter, match_req, subcategory_choices, price_filter, price_choices, rating_filter, rating_choices, band_filter, band_choices, facets = pagination('staff')
     
     form = AddToCartForm()
     mailing_list_form = MailingListForm()
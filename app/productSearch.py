@@ -0,0 +1,139 @@
+from sqlalchemy import event, text, false, inspect, func, select, table, column, literal_column, DDL
+from sqlalchemy.exc import OperationalError
+from bisect import bisect_left
+import difflib
+import re
+import threading
+import time
+
+from . import db
+from .models import Product
+
+# Full-text catalog search
+# product_search is an SQLite FTS5 table over product name, creator and description (rowid = product id),
+# kept in step with the products table by the mapper events below, in the same transaction as the change.
+# Searches are ranked with bm25 (name > creator > description), every word also matches as a prefix,
+# and words that aren't in the index are widened to the closest indexed words, so small typos still match.
+# The listing query joins the matches (rowid, bm25 rank) on product id in SQL, so every match is found and counted.
+SEARCH_TABLE = 'product_search'
+SEARCH_COLUMNS = ('name', 'creator', 'description')
+COLUMN_WEIGHTS = (10.0, 5.0, 1.0)  # name, creator, description
+VOCABULARY_TTL = 60  # seconds, picks up words indexed by other workers
+
+CREATE_SEARCH_TABLE = (
+    f"CREATE VIRTUAL TABLE IF NOT EXISTS {SEARCH_TABLE} USING fts5("
+    "name, creator, description, tokenize='unicode61 remove_diacritics 2', prefix='2 3')"
+)
+CREATE_VOCABULARY_TABLE = f"CREATE VIRTUAL TABLE IF NOT EXISTS {SEARCH_TABLE}_vocab USING fts5vocab({SEARCH_TABLE}, row)"
+
+search_table = table(SEARCH_TABLE, column('rowid'))
+
+# created together with the products table on a fresh database
+event.listen(Product.__table__, 'after_create', DDL(CREATE_SEARCH_TABLE).execute_if(dialect='sqlite'))
+event.listen(Product.__table__, 'after_create', DDL(CREATE_VOCABULARY_TABLE).execute_if(dialect='sqlite'))
+
+_vocabulary = {'terms': [], 'loaded_at': None}
+_vocabulary_lock = threading.Lock()
+
+def search_available():
+    return db.engine.dialect.name == 'sqlite'
+
+def create_search_index():
+    # for databases created before the search index existed, or changed outside the ORM
+    if not search_available():
+        return
+    try:
+        db.session.execute(text(CREATE_SEARCH_TABLE))
+        db.session.execute(text(CREATE_VOCABULARY_TABLE))
+        indexed = db.session.execute(text(f"SELECT count(*) FROM {SEARCH_TABLE}")).scalar()
+        if indexed != Product.query.count():
+            rebuild_search_index()
+        db.session.commit()
+    except OperationalError as e:
+        db.session.rollback()
+        print(f"Full-text search unavailable, falling back to LIKE: {e}")
+
+def rebuild_search_index():
+    db.session.execute(text(f"DELETE FROM {SEARCH_TABLE}"))
+    db.session.execute(text(
+        f"INSERT INTO {SEARCH_TABLE}(rowid, name, creator, description) "
+        "SELECT id, coalesce(name, ''), coalesce(creator, ''), coalesce(description, '') FROM products"
+    ))
+    _vocabulary['loaded_at'] = None
+    print('Rebuilt product search index!')
+
+@event.listens_for(Product, 'after_update')
+def reindex_product(mapper, connection, product):
+    # stock, price and rating updates don't touch the index
+    state = inspect(product)
+    if any(state.attrs[column].history.has_changes() for column in SEARCH_COLUMNS):
+        index_product(mapper, connection, product)
+
+@event.listens_for(Product, 'after_insert')
+def index_product(mapper, connection, product):
+    if connection.dialect.name != 'sqlite':
+        return
+    connection.execute(text(f"DELETE FROM {SEARCH_TABLE} WHERE rowid = :id"), {'id': product.id})
+    connection.execute(
+        text(f"INSERT INTO {SEARCH_TABLE}(rowid, name, creator, description) VALUES (:id, :name, :creator, :description)"),
+        {'id': product.id, 'name': product.name or '', 'creator': product.creator or '', 'description': product.description or ''}
+    )
+    _vocabulary['loaded_at'] = None
+
+@event.listens_for(Product, 'after_delete')
+def unindex_product(mapper, connection, product):
+    if connection.dialect.name != 'sqlite':
+        return
+    connection.execute(text(f"DELETE FROM {SEARCH_TABLE} WHERE rowid = :id"), {'id': product.id})
+    _vocabulary['loaded_at'] = None
+
+def vocabulary():
+    # sorted list of every indexed word
+    loaded_at = _vocabulary['loaded_at']
+    if loaded_at is None or time.monotonic() - loaded_at > VOCABULARY_TTL:
+        with _vocabulary_lock:
+            terms = db.session.execute(text(f"SELECT term FROM {SEARCH_TABLE}_vocab ORDER BY term")).scalars().all()
+            _vocabulary['terms'] = terms
+            _vocabulary['loaded_at'] = time.monotonic()
+    return _vocabulary['terms']
+
+def has_prefix(terms, word):
+    i = bisect_left(terms, word)
+    return i < len(terms) and terms[i].startswith(word)
+
+def match_expression(search_query):
+    words = re.findall(r'\w+', search_query.lower())
+    if not words:
+        return None
+    terms = vocabulary()
+    clauses = []
+    for word in words:
+        options = [f'"{word}"*']
+        if len(word) >= 3 and not has_prefix(terms, word):
+            # typo tolerance, e.g. "beatels" -> "beatles"
+            options += [f'"{term}"' for term in difflib.get_close_matches(word, terms, n=3, cutoff=0.75)]
+        clauses.append('(' + ' OR '.join(options) + ')')
+    return ' AND '.join(clauses)
+
+def search_products(products_query, search_query):
+    """
+    Filter products_query down to products matching search_query.
+    Returns the filtered query and the relevance ordering, pass the latter to order_by after any user-chosen sort.
+    """
+    if search_available():
+        try:
+            expression = match_expression(search_query)
+        except OperationalError as e:
+            db.session.rollback()
+            print(f"Full-text search failed, falling back to LIKE: {e}")
+        else:
+            if expression is None:
+                return products_query.filter(false()), []
+            # ranked in a materialised CTE, bm25 can't run inside the grouped listing queries it is joined to
+            # it is lower for better matches, so relevance sorts ascending
+            matches = select(
+                search_table.c.rowid.label('product_id'),
+                func.bm25(literal_column(SEARCH_TABLE), *COLUMN_WEIGHTS).label('rank')
+            ).where(literal_column(SEARCH_TABLE).op('MATCH')(expression)).cte('search_matches').prefix_with('MATERIALIZED')
+            return products_query.join(matches, matches.c.product_id == Product.id), [matches.c.rank]
+    return products_query.filter(Product.name.ilike(f"%{search_query}%")), []
@@ -0,0 +1,73 @@
+from flask import current_app
+from collections import OrderedDict
+import threading
+import time
+
+# In-process LRU caches with an optional time-to-live
+# Used for search queries that are repeated a lot (e.g. the same album cover uploaded over and over).
+# Each worker process has its own caches, hit/miss counters are per process too.
+class LRUCache:
+    def __init__(self, max_size=256, ttl=None):
+        self.max_size = max_size
+        self.ttl = ttl  # seconds, None keeps entries until they are evicted
+        self.generation = None
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()  # key -> (expires at, value)
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and (entry[0] is None or entry[0] > time.monotonic()):
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry[1]
+            if entry is not None:
+                del self._entries[key]
+            self.misses += 1
+            return None
+
+    def set(self, key, value):
+        expires = time.monotonic() + self.ttl if self.ttl else None
+        with self._lock:
+            self._entries[key] = (expires, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def sync_generation(self, generation):
+        # drop everything computed against an older catalog
+        with self._lock:
+            if generation != self.generation:
+                self._entries.clear()
+                self.generation = generation
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            'size': len(self._entries),
+            'max_size': self.max_size,
+            'ttl': self.ttl,
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': round(self.hits / lookups, 4) if lookups else None
+        }
+
+_caches_lock = threading.Lock()
+
+def get_cache(name, max_size=None, ttl=None):
+    # max_size and ttl default to QUERY_CACHE_SIZE and QUERY_CACHE_TTL, they only apply when the cache is created
+    caches = current_app.config.setdefault('QUERY_CACHES', {})
+    if name not in caches:
+        with _caches_lock:
+            if name not in caches:
+                caches[name] = LRUCache(max_size or current_app.config['QUERY_CACHE_SIZE'], ttl or current_app.config['QUERY_CACHE_TTL'])
+    return caches[name]
+
+def cache_stats():
+    return {name: cache.stats() for name, cache in current_app.config.get('QUERY_CACHES', {}).items()}
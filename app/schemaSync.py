@@ -0,0 +1,27 @@
+from sqlalchemy import inspect, text
+
+from . import db
+
+# Startup schema upgrades for existing databases
+# db.create_all() only creates missing tables, so columns and indexes added to existing models are added here.
+# Only additive changes are handled: new tables, new columns (nullable or with a server_default) and new indexes.
+def upgrade_schema():
+    db.create_all()
+    inspector = inspect(db.engine)
+    added = []
+    with db.engine.begin() as connection:
+        for table in db.metadata.sorted_tables:
+            existing = {column['name'] for column in inspector.get_columns(table.name)}
+            for column in table.columns:
+                if column.name in existing:
+                    continue
+                ddl = f"ALTER TABLE {table.name} ADD COLUMN {column.name} {column.type.compile(dialect=db.engine.dialect)}"
+                if column.server_default is not None:
+                    ddl += f" DEFAULT {column.server_default.arg}"
+                connection.execute(text(ddl))
+                added.append(f"{table.name}.{column.name}")
+            for index in table.indexes:
+                index.create(bind=connection, checkfirst=True)
+    if added:
+        print(f"Added columns: {', '.join(added)}")
+    return added
@@ -0,0 +1,76 @@
+// Search-as-you-type suggestions under the navbar search bar
+document.addEventListener('DOMContentLoaded', function () {
+    const searchBar = document.getElementById('search__bar');
+    if (!searchBar) {
+        return;
+    }
+
+    const list = document.createElement('ul');
+    list.className = 'search__suggestions';
+    list.style.display = 'none';
+    searchBar.parentElement.appendChild(list);
+
+    const labels = { product: 'Product', creator: 'Artist', genre: 'Genre' };
+    let timer = null;
+    let latest = 0;
+
+    function hide() {
+        list.style.display = 'none';
+        searchBar.classList.remove('focused');
+    }
+
+    function render(suggestions) {
+        list.innerHTML = '';
+        if (!suggestions.length) {
+            hide();
+            return;
+        }
+        suggestions.forEach(suggestion => {
+            const item = document.createElement('li');
+            const link = document.createElement('a');
+            link.href = suggestion.url;
+            link.textContent = suggestion.label;
+            const type = document.createElement('span');
+            type.className = 'suggestion__type';
+            type.textContent = labels[suggestion.type] || '';
+            link.appendChild(type);
+            item.appendChild(link);
+            list.appendChild(item);
+        });
+        list.style.display = 'block';
+        searchBar.classList.add('focused');
+    }
+
+    searchBar.addEventListener('input', function () {
+        clearTimeout(timer);
+        const query = searchBar.value.trim();
+        if (!query) {
+            hide();
+            return;
+        }
+        // wait for a short pause in typing, and ignore replies to older keystrokes
+        timer = setTimeout(() => {
+            const request = ++latest;
+            fetch(`/products/autocomplete?q=${encodeURIComponent(query)}`)
+                .then(response => response.json())
+                .then(data => {
+                    if (request === latest) {
+                        render(data.suggestions);
+                    }
+                })
+                .catch(() => hide());
+        }, 120);
+    });
+
+    searchBar.addEventListener('keydown', function (e) {
+        if (e.key === 'Escape') {
+            hide();
+        }
+    });
+
+    document.addEventListener('click', function (e) {
+        if (!list.contains(e.target) && e.target !== searchBar) {
+            hide();
+        }
+    });
+});
@@ -0,0 +1,65 @@
+from flask import current_app
+from sqlalchemy import event
+from sqlalchemy.orm import Session
+import threading
+import time
+
+from .models import Category, SubCategory
+
+# Process-level cache of the categories and genres used for the filter choices
+# The taxonomy only changes when an admin edits it, so catalog pages read it from memory instead of querying it every time.
+# Category and subcategory writes invalidate it once their transaction commits (whichever code path makes them);
+# other worker processes pick the change up after TAXONOMY_CACHE_TTL seconds.
+class Taxonomy:
+    def __init__(self, categories, subcategories):
+        self.categories = categories  # [(id, name)], by id
+        self.subcategories = subcategories  # [(id, name, category name)], by id
+        self.built_at = time.monotonic()
+
+    def subcategories_of(self, category_name=None):
+        if not category_name:
+            return self.subcategories
+        return [subcategory for subcategory in self.subcategories if subcategory[2] == category_name.title()]
+
+_lock = threading.Lock()
+_taxonomy = None
+
+def get_taxonomy():
+    global _taxonomy
+    taxonomy = _taxonomy
+    if taxonomy is None or time.monotonic() - taxonomy.built_at > current_app.config['TAXONOMY_CACHE_TTL']:
+        with _lock:
+            categories = Category.query.with_entities(Category.id, Category.category_name).order_by(Category.id).all()
+            names = dict(categories)
+            subcategories = SubCategory.query.with_entities(SubCategory.id, SubCategory.subcategory_name, SubCategory.category_id).order_by(SubCategory.id).all()
+            taxonomy = Taxonomy(
+                [(category_id, name) for category_id, name in categories],
+                [(subcategory_id, name, names.get(category_id)) for subcategory_id, name, category_id in subcategories]
+            )
+            _taxonomy = taxonomy
+    return taxonomy
+
+def invalidate():
+    global _taxonomy
+    _taxonomy = None
+
+# invalidate once taxonomy changes are committed
+@event.listens_for(Category, 'after_insert')
+@event.listens_for(Category, 'after_update')
+@event.listens_for(Category, 'after_delete')
+@event.listens_for(SubCategory, 'after_insert')
+@event.listens_for(SubCategory, 'after_update')
+@event.listens_for(SubCategory, 'after_delete')
+def record_taxonomy_change(mapper, connection, target):
+    session = Session.object_session(target)
+    if session is not None:
+        session.info['taxonomy_changed'] = True
+
+@event.listens_for(Session, 'after_commit')
+def invalidate_on_commit(session):
+    if session.info.pop('taxonomy_changed', False):
+        invalidate()
+
+@event.listens_for(Session, 'after_soft_rollback')
+def discard_taxonomy_change(session, previous_transaction):
+    session.info.pop('taxonomy_changed', None)
@@ -0,0 +1,147 @@
+import numpy as np
+
+# Vector indexes for image search
+# Vectors are normalised once (at build time, or already on disk), so cosine similarity is a single dot product per row.
+# They can be searched as float16 or int8 codes (with one scale per vector) to cut memory 2-4x,
+# the final top-k is then reranked against the full-precision source matrix.
+# The embedding store saves the codes next to its matrix (see EmbeddingStore.save_codes), so they are memory-mapped
+# and shared by every worker like the matrix, instead of each worker quantising its own copy.
+
+PRECISIONS = ('float32', 'float16', 'int8')
+BLOCK_SIZE = 4096  # rows widened to float32 at a time when scoring quantised vectors
+
+def normalise(matrix):
+    matrix = np.asarray(matrix, dtype=np.float32)
+    norms = np.linalg.norm(matrix, axis=-1, keepdims=True)
+    norms[norms == 0] = 1
+    return matrix / norms
+
+def top_k(scores, k):
+    k = min(k, len(scores))
+    if k <= 0:
+        return np.array([], dtype=np.int64)
+    candidates = np.argpartition(-scores, k - 1)[:k]
+    return candidates[np.argsort(-scores[candidates])]
+
+def quantise(vectors, precision):
+    if precision == 'float16':
+        return vectors.astype(np.float16), None
+    if precision == 'int8':
+        scales = np.abs(vectors).max(axis=1) / 127
+        scales[scales == 0] = 1
+        return np.round(vectors / scales[:, None]).astype(np.int8), scales.astype(np.float32)
+    return vectors, None
+
+def quantise_matrix(matrix, precision):
+    # normalised codes for every row (and int8 scales), built in blocks so there is never a full float32 copy
+    n = len(matrix)
+    dim = matrix.shape[1] if n else 0
+    codes = np.zeros((n, dim), dtype=np.dtype(precision))
+    scales = np.ones(n, dtype=np.float32) if precision == 'int8' else None
+    for start in range(0, n, BLOCK_SIZE):
+        block_codes, block_scales = quantise(normalise(matrix[start:start + BLOCK_SIZE]), precision)
+        codes[start:start + len(block_codes)] = block_codes
+        if block_scales is not None:
+            scales[start:start + len(block_codes)] = block_scales
+    return codes, scales
+
+# Exact search, scans every vector
+# labels has one entry per matrix row, normalised=True means the matrix rows already have unit length
+# codes/scales are precomputed quantise_matrix(matrix, precision) results, e.g. memory-mapped from the embedding store
+class FlatIndex:
+    def __init__(self, matrix, labels, normalised=False, precision='float32', rerank=4, codes=None, scales=None):
+        if precision not in PRECISIONS:
+            raise ValueError(f"Unknown vector precision: {precision}")
+        self.labels = list(labels)
+        self.precision = precision
+        self.rerank = rerank  # candidates reranked at full precision per result
+        self.normalised = normalised
+        self.source = matrix  # full-precision rows, may be memory-mapped and shared with other workers
+
+        if precision == 'float32' and normalised:
+            # search the (memory-mapped) source directly, zero-copy
+            self.vectors, self.scales = matrix, None
+        elif codes is not None:
+            # shared codes, zero-copy as well
+            self.vectors, self.scales = codes, scales
+        else:
+            self.vectors, self.scales = quantise_matrix(matrix, precision)
+
+    def __len__(self):
+        return len(self.labels)
+
+    def full_vectors(self, positions):
+        vectors = np.asarray(self.source[positions], dtype=np.float32)
+        return vectors if self.normalised else normalise(vectors)
+
+    def scores(self, query, positions=None):
+        if self.precision == 'float32':
+            vectors = self.vectors if positions is None else self.vectors[positions]
+            return vectors @ query
+
+        positions = np.arange(len(self.labels)) if positions is None else positions
+        scores = np.empty(len(positions), dtype=np.float32)
+        for start in range(0, len(positions), BLOCK_SIZE):
+            block = positions[start:start + BLOCK_SIZE]
+            scores[start:start + len(block)] = self.vectors[block].astype(np.float32) @ query
+            if self.scales is not None:
+                scores[start:start + len(block)] *= self.scales[block]
+        return scores
+
+    def rank(self, query, positions, k):
+        scores = self.scores(query, positions)
+        if self.precision == 'float32':
+            best = top_k(scores, k)
+            return [(self.labels[positions[i]], float(1 - scores[i])) for i in best]
+
+        # approximate scores pick the candidates, full-precision vectors decide their order
+        candidates = positions[top_k(scores, k * self.rerank)]
+        exact = self.full_vectors(candidates) @ query
+        return [(self.labels[candidates[i]], float(1 - exact[i])) for i in top_k(exact, k)]
+
+    def search(self, query, k=1):
+        """Return up to k (label, cosine distance) pairs, closest first."""
+        if not self.labels:
+            return []
+        return self.rank(normalise(query), np.arange(len(self.labels)), k)
+
+# Inverted file index (IVF)
+# Vectors are clustered with spherical k-means, a query only scans the n_probe clusters closest to it.
+class IVFIndex(FlatIndex):
+    def __init__(self, matrix, labels, normalised=False, precision='float32', rerank=4, codes=None, scales=None, n_lists=None, n_probe=8, iterations=10, seed=0):
+        super().__init__(matrix, labels, normalised, precision, rerank, codes, scales)
+        n = len(self.labels)
+        self.n_lists = min(n_lists or max(1, int(np.sqrt(n))), n)
+        self.n_probe = min(n_probe, self.n_lists)
+
+        rng = np.random.default_rng(seed)
+        # train on a sample, large catalogs don't need every vector to place centroids
+        sample_positions = np.sort(rng.choice(n, min(n, self.n_lists * 256), replace=False))
+        sample = self.full_vectors(sample_positions)
+        centroids = sample[rng.choice(len(sample), self.n_lists, replace=False)].copy()
+        for _ in range(iterations):
+            assignments = np.argmax(sample @ centroids.T, axis=1)
+            for c in range(self.n_lists):
+                members = sample[assignments == c]
+                centroids[c] = members.sum(axis=0) if len(members) else sample[rng.integers(len(sample))]
+            centroids = normalise(centroids)
+        self.centroids = centroids
+
+        assignments = np.empty(n, dtype=np.int64)
+        for start in range(0, n, BLOCK_SIZE):
+            block = self.full_vectors(np.arange(start, min(start + BLOCK_SIZE, n)))
+            assignments[start:start + len(block)] = np.argmax(block @ self.centroids.T, axis=1)
+        self.lists = [np.flatnonzero(assignments == c) for c in range(self.n_lists)]
+
+    def search(self, query, k=1):
+        if not self.labels:
+            return []
+        query = normalise(query)
+        probes = top_k(self.centroids @ query, self.n_probe)
+        return self.rank(query, np.concatenate([self.lists[c] for c in probes]), k)
+
+def build_index(matrix, labels, normalised=False, ivf_threshold=5000, n_probe=8, precision='float32', codes=None, scales=None):
+    # brute force is both exact and fastest for small catalogs
+    if len(labels) >= ivf_threshold:
+        return IVFIndex(matrix, labels, normalised, precision, codes=codes, scales=scales, n_probe=n_probe)
+    return FlatIndex(matrix, labels, normalised, precision, codes=codes, scales=scales)
@@ -7,6 +7,8 @@ from sqlalchemy.dialects.postgresql import JSON
 from .roleDecorator import role_required
 from .forms import AddProductForm, DeleteProductForm, AddProductFormData, AddToCartForm #, EditProductForm
 from .models import Product, Category, SubCategory, ProductSubCategory, OrderItem, Cart
+from .productSearch import search_products
+from .loadProfiles import load_profile
 from . import db
 import os
 
@@ -26,12 +28,13 @@ def favourites():
     # Search logic
     search_query = request.args.get('q', '', type=str)
     if search_query != '':
-        products = products_query.filter(Product.name.ilike(f"%{search_query}%"))
+        products, search_order = search_products(products_query, search_query)
+        products = products.options(*load_profile('product_list')).order_by(*search_order)
         total_products = products.count()
     else:
         products = []
         if current_user.wishlisted_items:
-            products = Product.query.filter(Product.id.in_(current_user.wishlisted_items)).all()
+            products = Product.query.options(*load_profile('product_list')).filter(Product.id.in_(current_user.wishlisted_items)).all()
         total_products = products.__len__()
 
     return render_template('views/wishlist.html', 
@@ -0,0 +1,70 @@
+import pytest
+
+from app import create_app, db
+from app.loadProfiles import QUERY_BUDGETS
+from app.models import Product, User
+from app import taxonomy
+
+# Every route in QUERY_BUDGETS is requested against the seeded catalog (in-memory SQLite)
+# and has to stay within its budget, so an N+1 regression fails here instead of only being logged.
+# Requests are made cold: rendered pages, counts, facets and the taxonomy are not cached.
+
+# endpoint -> (path, user signed in)
+ROUTES = {
+    'productPagination.product_pagination': ('/products/', None),
+    'productPagination.product_specials': ('/products/featured/specials', None),
+    'productPagination.product_staff': ('/products/featured/staff_picks', None),
+    'productPagination.product_feed': ('/products/feed', None),
+    'productPagination.product_detail': ('/products/product/{product_id}', None),
+    'manageProducts.products_listing': ('/dashboard/manage-products', 'admin1'),
+    'wishlist.favourites': ('/wishlist', 'Customer')
+}
+
+@pytest.fixture(scope='module')
+def app(tmp_path_factory):
+    folder = tmp_path_factory.mktemp('instance')
+    with pytest.MonkeyPatch.context() as patch:
+        # create_database seeds when there is no instance/database.db in the working directory
+        patch.chdir(folder)
+        app = create_app({
+            'TESTING': True,
+            'SQLALCHEMY_DATABASE_URI': 'sqlite://',
+            'WTF_CSRF_ENABLED': False,
+            'QUERY_BUDGET_CHECK': True,
+            'JOB_WORKERS': 0,
+            'PRECOMPUTE_EMBEDDINGS': False,
+            'EMBEDDING_CACHE_FOLDER': str(folder / 'embeddings'),
+            'CATALOG_VERSION_FILE': str(folder / 'catalog_version')
+        })
+
+    with app.app_context():
+        # a wishlist with a few products, so the wishlist page has cards to render
+        customer = User.query.filter_by(username='Customer').first()
+        customer.wishlisted_items = [product_id for product_id, in Product.query.with_entities(Product.id).limit(6)]
+        db.session.commit()
+    return app
+
+def product_with_reviews(app):
+    with app.app_context():
+        return Product.query.filter(Product.rating_count > 0).order_by(Product.id).first().id
+
+@pytest.mark.parametrize('endpoint', sorted(QUERY_BUDGETS))
+def test_route_stays_within_query_budget(app, endpoint):
+    path, username = ROUTES[endpoint]
+    client = app.test_client()
+
+    with app.app_context():
+        if username:
+            user = User.query.filter_by(username=username).first()
+            with client.session_transaction() as session:
+                session['_user_id'] = str(user.id)
+                session['_fresh'] = True
+
+    app.config['QUERY_CACHES'] = {}
+    taxonomy.invalidate()
+
+    response = client.get(path.format(product_id=product_with_reviews(app)))
+
+    assert response.status_code == 200
+    count = int(response.headers['X-Query-Count'])
+    assert count <= QUERY_BUDGETS[endpoint], f"{endpoint} ran {count} queries, the budget is {QUERY_BUDGETS[endpoint]}"